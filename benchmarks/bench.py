@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the crypto and parsing hot paths.
+
+Run from the repository root:
+
+    python3 -m benchmarks.bench                    # run, compare against benchmarks/baseline.json if present
+    python3 -m benchmarks.bench --save-baseline    # run and store the results as the new baseline
+    python3 -m benchmarks.bench -k decrypt --check # only matching benchmarks, exit 1 on a regression
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.finder import FinderDevice, generate_owner_key
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baseline.json")
+
+
+def measure(operation, min_time: float, batch: int) -> {}:
+    # Times batches of calls until min_time has passed, per-call latencies are taken per batch
+    for _ in range(batch):
+        operation()
+    samples = []
+    started = time.perf_counter()
+    while time.perf_counter() - started < min_time or len(samples) < 5:
+        begin = time.perf_counter_ns()
+        for _ in range(batch):
+            operation()
+        samples.append((time.perf_counter_ns() - begin) / batch)
+    samples.sort()
+    total = sum(samples)
+
+    def percentile(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] / 1000
+
+    return {"ops_per_sec": len(samples) * 1e9 / total, "p50_us": percentile(0.50), "p95_us": percentile(0.95),
+            "p99_us": percentile(0.99), "calls": len(samples) * batch}
+
+
+def build_benchmarks(items: int) -> {}:
+    # name -> (operation, calls per sample)
+    from cores.decryptor import BatchDecryptor
+    from cores.key_cache import private_key_cache
+    from cores.key_map import KeyMap, derive_key_pair
+    from cores.report_stream import ReportStreamParser
+    from cores.report_decoder import decode_location, decrypt_report, decrypt_reports
+    from cores.report_triage import triage_reports
+    from cores.storage import ReportStore
+    from generate_keys import generate_key
+
+    private_key, advertisement_key, hashed_adv_key = generate_owner_key()
+    finder = FinderDevice(advertisement_key)
+    report_88 = finder.report(fmt=88)
+    report_89 = finder.report(fmt=89)
+    reports = [finder.report(fmt=88 + index % 2) for index in range(items)]
+    results = [{"datePublished": 0, "payload": payload, "id": hashed_adv_key, "statusCode": 0}
+               for payload in reports]
+    upload = json.dumps({"statusCode": "200", "results": results}).encode()
+    private_key_cache.get(private_key)
+
+    store = ReportStore(os.path.join(tempfile.mkdtemp(), "bench.db"))
+    key_map = KeyMap(store)
+    key_map.lookup(private_key)
+    inline_decryptor = BatchDecryptor(max_workers=0)
+    pairs = [(payload, private_key) for payload in reports]
+
+    benchmarks = {
+        "decrypt_payload_88": (lambda: decrypt_report(report_88, private_key), 20),
+        "decrypt_payload_89": (lambda: decrypt_report(report_89, private_key), 20),
+        "derive_key_pair": (lambda: derive_key_pair(generate_owner_key()[0]), 10),
+        "private_to_hashed_key_memo": (lambda: key_map.lookup(private_key), 1000),
+        "decode_location": (lambda: decode_location(b'\x01\x63\x45\x67\xf8\x12\x34\x56\x0a\x00'), 10000),
+        "generate_key": (lambda: generate_key(False), 10),
+        "finder_report": (lambda: finder.report(), 10),
+        f"triage_reports_{items}": (lambda: triage_reports(reports, [hashed_adv_key] * items), 1),
+        f"parse_upload_{items}": (lambda: sum(1 for _ in ReportStreamParser(io.BytesIO(upload)).reports()), 1),
+        f"batch_decrypt_inline_{items}": (lambda: inline_decryptor.decrypt(pairs), 1),
+        f"decrypt_reports_{items}": (lambda: decrypt_reports(reports, private_key), 1),
+    }
+
+    # Imported here, web_service pulls in FastAPI and the rest of the server
+    from web_service import input_sanitize
+    benchmarks["input_sanitize"] = (lambda: input_sanitize(f" {private_key} "), 10000)
+    return benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FindMy hot path micro-benchmarks")
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("-t", "--min-time", type=float, default=1.0, help="seconds to measure each benchmark")
+    parser.add_argument("-n", "--items", type=int, default=500, help="reports per batch benchmark")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file to compare with or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent of ops/sec lost before a benchmark counts as regressed (default: 10)")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 when a benchmark regressed")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':34} {'ops/sec':>12} {'p50 us':>10} {'p95 us':>10} {'p99 us':>10} {'vs baseline':>12}")
+    for name, (operation, batch) in build_benchmarks(args.items).items():
+        if args.filter not in name:
+            continue
+        result = measure(operation, args.min_time, batch)
+        results[name] = result
+        change = ""
+        if name in baseline:
+            delta = (result["ops_per_sec"] / baseline[name]["ops_per_sec"] - 1) * 100
+            change = f"{delta:+.1f}%"
+            if delta < -args.threshold:
+                regressions.append(name)
+                change += " !"
+        print(f"{name:34} {result['ops_per_sec']:12.1f} {result['p50_us']:10.1f} {result['p95_us']:10.1f} "
+              f"{result['p99_us']:10.1f} {change:>12}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"python": sys.version.split()[0], "created": int(time.time()), "results": results}, f,
+                      indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    if regressions:
+        print(f"Regressed by more than {args.threshold}%: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import base64
+import hashlib
+import os
+import struct
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from cores.report_decoder import APPLE_EPOCH
+
+
+def generate_owner_key() -> (str, str, str):
+    # Returns (private key, advertisement key, hashed adv key) in base64, as generate_keys.py writes them
+    private_key = ec.generate_private_key(ec.SECP224R1())
+    private_key_bytes = private_key.private_numbers().private_value.to_bytes(28, byteorder='big')
+    public_key_bytes = private_key.public_key().public_numbers().x.to_bytes(28, byteorder='big')
+    return (base64.b64encode(private_key_bytes).decode("ascii"),
+            base64.b64encode(public_key_bytes).decode("ascii"),
+            base64.b64encode(hashlib.sha256(public_key_bytes).digest()).decode("ascii"))
+
+
+class FinderDevice:
+    """
+    Produces encrypted location reports the way a finder device does for an advertisement key it overheard.
+
+    The advertisement key only carries the x coordinate of the owner's public key, the finder takes either point
+    with that x, both give the owner the same ECDH shared secret. Each report uses a fresh ephemeral key, derives
+    the AES-GCM key and IV from SHA256(shared secret || 00000001 || ephemeral key) and encrypts latitude,
+    longitude, horizontal accuracy and status. ``fmt`` selects the 88-byte layout with a 1-byte confidence or
+    the 89-byte layout with a 2-byte confidence.
+    """
+
+    def __init__(self, advertisement_key: str):
+        self.advertisement_key = advertisement_key
+        self.hashed_adv_key = base64.b64encode(
+            hashlib.sha256(base64.b64decode(advertisement_key)).digest()).decode("ascii")
+        self._owner_key = ec.EllipticCurvePublicKey.from_encoded_point(
+            ec.SECP224R1(), b'\x02' + base64.b64decode(advertisement_key))
+
+    def report(self, timestamp: int = None, lat: float = 37.3349, lon: float = -122.009, confidence: int = 80,
+               horizontal_accuracy: int = 10, status: int = 0, fmt: int = 88) -> str:
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        ephemeral = ec.generate_private_key(ec.SECP224R1())
+        ephemeral_bytes = ephemeral.public_key().public_bytes(serialization.Encoding.X962,
+                                                              serialization.PublicFormat.UncompressedPoint)
+        shared_key = ephemeral.exchange(ec.ECDH(), self._owner_key)
+        symmetric_key = hashlib.sha256(shared_key + b'\x00\x00\x00\x01' + ephemeral_bytes).digest()
+
+        clear_text = struct.pack(">ii", int(lat * 10000000), int(lon * 10000000)) + \
+            bytes([horizontal_accuracy, status])
+        # AESGCM appends the 16-byte tag to the cipher text
+        cipher_text = AESGCM(symmetric_key[:16]).encrypt(symmetric_key[16:], clear_text, None)
+
+        confidence_bytes = confidence.to_bytes(1 if fmt == 88 else 2, byteorder="big")
+        data = (timestamp - APPLE_EPOCH).to_bytes(4, byteorder="big") + confidence_bytes + ephemeral_bytes + \
+            cipher_text
+        return base64.b64encode(data).decode("ascii")
+
+    def fetch_result(self, date_published: int = None, **kwargs) -> {}:
+        # One element of the fetch response "results" array
+        return {"datePublished": int(time.time() * 1000) if date_published is None else date_published,
+                "payload": self.report(**kwargs), "description": "found", "id": self.hashed_adv_key,
+                "statusCode": 0}
+
+
+def random_location() -> (float, float):
+    # Somewhere plausible, uniformly inside a box around Cupertino
+    lat = 37.30 + int.from_bytes(os.urandom(2), "big") / 65535 * 0.1
+    lon = -122.05 + int.from_bytes(os.urandom(2), "big") / 65535 * 0.1
+    return lat, lon
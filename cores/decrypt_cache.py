@@ -0,0 +1,110 @@
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from cores.storage import select_in
+
+
+class DecryptCache:
+    """
+    Decrypted report cache, keyed on a digest of the private key and the payload.
+
+    The same payload comes back from overlapping fetch windows and repeated uploads, a hit skips the ECDH and
+    AES-GCM work. The private key is part of the key, so a payload is only ever answered for the key that
+    decrypted it. Lookups go through an in-memory LRU of ``maxsize`` entries, then the ``decrypt_cache`` table
+    when a ``store`` is given. Only successful decryptions are cached, persisted entries whose report is older than
+    ``max_age`` seconds are pruned, Apple does not return those reports anymore.
+    """
+
+    def __init__(self, store=None, maxsize: int = 65536, max_age: float = 8 * 24 * 3600,
+                 prune_interval: float = 3600):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = store
+        self._pruned_at = 0.0
+
+    @staticmethod
+    def key(payload: str, private_key: str) -> bytes:
+        return hashlib.sha256(private_key.encode() + b':' + payload.encode()).digest()[:16]
+
+    @staticmethod
+    def _result(entry: tuple) -> {}:
+        # entry is (hashed adv key, timestamp, lat, lon, confidence, status, horizontal_accuracy)
+        _, timestamp, lat, lon, confidence, status, horizontal_accuracy = entry
+        return {'timestamp': timestamp, 'isodatetime': datetime.datetime.fromtimestamp(timestamp).isoformat(),
+                'lat': lat, 'lon': lon, 'confidence': confidence, 'status': status,
+                'horizontal_accuracy': horizontal_accuracy, 'decrypt_success': True, 'fail_reason': ''}
+
+    def _remember(self, key: bytes, entry: tuple):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_many(self, keys) -> {}:
+        # Maps every cached key to a fresh copy of its decrypted payload, keys that are not cached are left out
+        found = {}
+        with self._lock:
+            missing = []
+            for key in set(keys):
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = self._result(entry)
+                    self.hits += 1
+                else:
+                    missing.append(key)
+
+            if self._store is not None and missing:
+                rows = select_in(self._store.connection(),
+                                 "SELECT key, id, timestamp, lat, lon, conf, status, horizontal_accuracy "
+                                 "FROM decrypt_cache WHERE key IN ({})", missing)
+                for row in rows:
+                    self._remember(row[0], row[1:])
+                    found[row[0]] = self._result(row[1:])
+                    self.db_hits += 1
+            self.misses += len(missing) - sum(1 for key in missing if key in found)
+        return found
+
+    def put_many(self, entries):
+        # entries are (key, hashed adv key, decrypted payload), payloads that failed to decrypt are skipped
+        rows = [(key, hash_adv_key, result['timestamp'], result['lat'], result['lon'], result['confidence'],
+                 result['status'], result['horizontal_accuracy'])
+                for key, hash_adv_key, result in entries if result.get('decrypt_success')]
+        with self._lock:
+            for row in rows:
+                self._remember(row[0], row[1:])
+            if self._store is None or not rows:
+                return
+            conn = self._store.connection()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO decrypt_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                if time.monotonic() - self._pruned_at >= self.prune_interval:
+                    self._pruned_at = time.monotonic()
+                    conn.execute("DELETE FROM decrypt_cache WHERE timestamp < ?", (int(time.time() - self.max_age),))
+
+    def forget(self, hash_adv_keys):
+        # Drop everything cached for these tags, from memory and the table
+        hash_adv_keys = set(hash_adv_keys)
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] in hash_adv_keys]:
+                del self._entries[key]
+            if self._store is not None:
+                conn = self._store.connection()
+                with conn:
+                    conn.executemany("DELETE FROM decrypt_cache WHERE id = ?", [(key,) for key in hash_adv_keys])
+
+    def stats(self) -> {}:
+        with self._lock:
+            return {'hits': self.hits, 'db_hits': self.db_hits, 'misses': self.misses, 'size': len(self._entries),
+                    'maxsize': self.maxsize, 'persistent': self._store is not None}
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from cores.report_decoder import decrypt_reports
+
+
+class BatchDecryptor:
+    """
+    Decrypt many (payload, private key) pairs at once.
+
+    Pairs are grouped by private key, large groups are split into chunks of ``chunk_size`` and the chunks are
+    fanned out over a process pool. Results are returned in the order of the input pairs. With ``max_workers``
+    set to 0, or for batches smaller than ``inline_threshold``, decryption runs in the calling process.
+    """
+
+    def __init__(self, max_workers: int | None = None, chunk_size: int = 256, inline_threshold: int = 32):
+        self.max_workers = (os.cpu_count() or 1) if max_workers is None else max_workers
+        self.chunk_size = max(1, chunk_size)
+        self.inline_threshold = inline_threshold
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _chunks(self, pairs: list) -> list:
+        groups = {}
+        for index, (payload, private_key) in enumerate(pairs):
+            groups.setdefault(private_key, []).append((index, payload))
+
+        chunks = []
+        for private_key, items in groups.items():
+            for start in range(0, len(items), self.chunk_size):
+                chunks.append((private_key, items[start:start + self.chunk_size]))
+        return chunks
+
+    def decrypt(self, pairs: list) -> list:
+        results = [None] * len(pairs)
+        chunks = self._chunks(pairs)
+
+        if self.max_workers == 0 or len(pairs) < self.inline_threshold:
+            for private_key, items in chunks:
+                decrypted = decrypt_reports([payload for _, payload in items], private_key)
+                for (index, _), result in zip(items, decrypted):
+                    results[index] = result
+            return results
+
+        executor = self._get_executor()
+        futures = [(items, executor.submit(decrypt_reports, [payload for _, payload in items], private_key))
+                   for private_key, items in chunks]
+        for items, future in futures:
+            for (index, _), result in zip(items, future.result()):
+                results[index] = result
+
+        logging.debug(f"Decrypted {len(pairs)} reports in {len(chunks)} chunks")
+        return results
+
+    async def decrypt_async(self, pairs: list) -> list:
+        # Dispatch from a thread so the event loop is never blocked while waiting on the pool
+        return await asyncio.get_running_loop().run_in_executor(None, self.decrypt, pairs)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
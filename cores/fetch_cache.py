@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+class FetchCache:
+    """
+    Short-TTL cache with single-flight coalescing for upstream fetches.
+
+    Identical queries issued while one is already in flight await the same task instead of reaching Apple again.
+    Results accepted by ``cacheable`` are kept for ``ttl`` seconds, the oldest entries are evicted once more than
+    ``maxsize`` are held. A ``ttl`` of 0 disables caching but keeps coalescing.
+
+    With a ``store``, results are also shared through the ``fetch_cache`` table, so processes using the same
+    reports.db answer each other's recent queries. Values must then be JSON serializable. Coalescing stays
+    within one process.
+    """
+
+    def __init__(self, ttl: float = 30.0, maxsize: int = 1024, cacheable=None, store=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cacheable = cacheable or (lambda value: True)
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._store = store
+
+    @staticmethod
+    def _db_key(key) -> bytes:
+        return hashlib.sha256(repr(key).encode()).digest()[:16]
+
+    def _load(self, key) -> tuple | None:
+        # (value, age) of a result another process stored within the TTL
+        row = self._store.connection().execute(
+            "SELECT fetched_at, value FROM fetch_cache WHERE key = ?", (self._db_key(key),)).fetchone()
+        if row is None or time.time() - row[0] >= self.ttl:
+            return None
+        return json.loads(row[1]), time.time() - row[0]
+
+    def _save(self, key, value):
+        now = time.time()
+        conn = self._store.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO fetch_cache VALUES (?, ?, ?)",
+                         (self._db_key(key), now, json.dumps(value, separators=(',', ':'))))
+            conn.execute("DELETE FROM fetch_cache WHERE fetched_at < ?", (now - self.ttl,))
+
+    async def _fetch(self, key, fetch) -> (object, float, bool):
+        # (value, age, whether it came from the table)
+        if self._store is not None and self.ttl > 0:
+            shared = await asyncio.to_thread(self._load, key)
+            if shared is not None:
+                self.db_hits += 1
+                return shared[0], shared[1], True
+        self.misses += 1
+        value = await fetch()
+        if self._store is not None and self.ttl > 0 and self.cacheable(value):
+            await asyncio.to_thread(self._save, key, value)
+        return value, 0.0, False
+
+    def _remember(self, key, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.ttl <= 0:
+            return
+        value, age, _ = task.result()
+        if self.cacheable(value):
+            self._entries[key] = (time.monotonic() - age, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, key, fetch) -> (object, str, float):
+        """
+        Return ``(value, status, age)`` where status is HIT, COALESCED or MISS and age is the seconds since the
+        value was fetched. ``fetch`` is a zero-argument coroutine function, called only on a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], "HIT", age
+            del self._entries[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            value, age, _ = await asyncio.shield(task)
+            return value, "COALESCED", age
+
+        task = asyncio.ensure_future(self._fetch(key, fetch))
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._remember(key, done))
+        # Shield the shared task so one cancelled client does not cancel it for everyone else
+        value, age, shared = await asyncio.shield(task)
+        return value, "HIT" if shared else "MISS", age
+
+    def stats(self) -> {}:
+        return {'hits': self.hits, 'db_hits': self.db_hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                'size': len(self._entries), 'inflight': len(self._inflight), 'maxsize': self.maxsize,
+                'ttl': self.ttl, 'shared': self._store is not None}
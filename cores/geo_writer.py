@@ -0,0 +1,52 @@
+import json
+from xml.sax.saxutils import escape
+
+
+class KmlWriter:
+    """
+    Writes a KML document piece by piece: ``header()``, one ``placemark()`` per point, then ``footer()``.
+    Nothing is kept between calls, so a document of any length can be streamed.
+    """
+
+    media_type = "application/vnd.google-earth.kml+xml"
+    extension = "kml"
+
+    def header(self) -> str:
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+                '<Document>\n')
+
+    def placemark(self, name: str, when: str, lat: float, lon: float, properties: {}) -> str:
+        return (f'<Placemark><name>{escape(name)}</name><TimeStamp><when>{escape(when)}</when></TimeStamp>'
+                f'<Point><coordinates>{lon},{lat},0.0</coordinates></Point></Placemark>\n')
+
+    def footer(self, error: str = None) -> str:
+        # The document is already on its way, an error found later is left as a comment at the end
+        comment = f'<!-- error: {escape(error).replace("--", "- -")} -->\n' if error else ''
+        return comment + '</Document>\n</kml>\n'
+
+
+class GeoJsonWriter:
+    """
+    Writes a GeoJSON FeatureCollection piece by piece, same interface as KmlWriter.
+    An error found after streaming started is added as an ``error`` member of the collection.
+    """
+
+    media_type = "application/geo+json"
+    extension = "geojson"
+
+    def __init__(self):
+        self._first = True
+
+    def header(self) -> str:
+        return '{"type":"FeatureCollection","features":[\n'
+
+    def placemark(self, name: str, when: str, lat: float, lon: float, properties: {}) -> str:
+        feature = {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                   "properties": {"name": name, "time": when, **properties}}
+        separator = '' if self._first else ','
+        self._first = False
+        return separator + json.dumps(feature, separators=(',', ':')) + '\n'
+
+    def footer(self, error: str = None) -> str:
+        return ']' + (f',"error":{json.dumps(error)}' if error else '') + '}\n'
@@ -0,0 +1,56 @@
+import base64
+import threading
+from collections import OrderedDict
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+
+
+class PrivateKeyCache:
+    """
+    Bounded, thread-safe LRU cache of derived SECP224R1 private key objects, keyed on the base64 private key.
+
+    Deriving the key is a scalar multiplication, caching it means every report of a tag after the first one
+    only pays for the ECDH exchange.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, private_key_b64: str) -> ec.EllipticCurvePrivateKey:
+        with self._lock:
+            private_key = self._keys.get(private_key_b64)
+            if private_key is not None:
+                self._keys.move_to_end(private_key_b64)
+                self.hits += 1
+                return private_key
+            self.misses += 1
+
+        # Derive outside the lock, a concurrent miss on the same key only costs a duplicate derivation
+        private_key = ec.derive_private_key(int.from_bytes(base64.b64decode(private_key_b64), byteorder="big"),
+                                            ec.SECP224R1(), default_backend())
+
+        with self._lock:
+            self._keys[private_key_b64] = private_key
+            self._keys.move_to_end(private_key_b64)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return private_key
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> {}:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._keys), 'maxsize': self.maxsize}
+
+
+# Shared by every decrypt path in this process, pool workers each get their own copy
+private_key_cache = PrivateKeyCache()
@@ -0,0 +1,104 @@
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from cores.key_cache import private_key_cache
+from cores.storage import private_key_digest, select_in
+
+
+def derive_key_pair(private_key_b64: str) -> (str, str):
+    # Returns (hashed advertisement key, advertisement key), both in base64
+    public_key = private_key_cache.get(private_key_b64).public_key()
+    public_key_bytes = public_key.public_numbers().x.to_bytes(28, byteorder='big')
+    hash_adv_key = base64.b64encode(hashlib.sha256(public_key_bytes).digest()).decode("ascii")
+    return hash_adv_key, base64.b64encode(public_key_bytes).decode("ascii")
+
+
+class KeyMap:
+    """
+    Memoized private key to (hashed advertisement key, advertisement key) mapping.
+
+    Lookups go through an in-memory LRU first, then the ``key_map`` table, and only derive with EC math when the
+    key has never been seen. Derived pairs are written back to the table so they survive restarts, keyed on a
+    digest of the private key so the key itself is never stored.
+    """
+
+    def __init__(self, store, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = store
+
+    def _remember(self, private_key_b64: str, pair: (str, str)):
+        self._keys[private_key_b64] = pair
+        self._keys.move_to_end(private_key_b64)
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+
+    def lookup(self, private_key_b64: str) -> (str, str):
+        pairs = self.lookup_many([private_key_b64])
+        if private_key_b64 not in pairs:
+            raise ValueError(f"Private Key Decode Failed: {private_key_b64}")
+        return pairs[private_key_b64]
+
+    def lookup_many(self, private_keys) -> {}:
+        """
+        Map each private key to its (hashed advertisement key, advertisement key) pair.
+        Keys that cannot be derived are logged and left out of the result.
+        """
+        pairs = {}
+        with self._lock:
+            missing = []
+            for key in set(private_keys):
+                if key in self._keys:
+                    self._keys.move_to_end(key)
+                    pairs[key] = self._keys[key]
+                    self.hits += 1
+                else:
+                    missing.append(key)
+
+            conn = self._store.connection()
+            digests = {private_key_digest(key): key for key in missing}
+            rows = select_in(conn, "SELECT key_digest, hash_adv_key, public_key FROM key_map WHERE key_digest IN ({})",
+                             digests)
+            for key_digest, hash_adv_key, public_key in rows:
+                private_key = digests[key_digest]
+                pairs[private_key] = (hash_adv_key, public_key)
+                self._remember(private_key, pairs[private_key])
+                self.db_hits += 1
+
+            derived = []
+            for key in missing:
+                if key in pairs:
+                    continue
+                try:
+                    pairs[key] = derive_key_pair(key)
+                except Exception as e:
+                    logging.error(f"Private Key Decode Failed: {e}")
+                    continue
+                self._remember(key, pairs[key])
+                derived.append((private_key_digest(key),) + pairs[key])
+                self.misses += 1
+
+            if derived:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO key_map VALUES (?, ?, ?)", derived)
+        return pairs
+
+    def forget(self, keys):
+        # Drop the in-memory entries of these private or hashed advertisement keys, the rows go with
+        # ReportStore.remove_keys
+        keys = set(keys)
+        with self._lock:
+            for key in [key for key, pair in self._keys.items() if key in keys or pair[0] in keys]:
+                del self._keys[key]
+
+    def stats(self) -> {}:
+        with self._lock:
+            return {'hits': self.hits, 'db_hits': self.db_hits, 'misses': self.misses, 'size': len(self._keys),
+                    'maxsize': self.maxsize}
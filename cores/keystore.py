@@ -0,0 +1,247 @@
+import base64
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from cores.key_map import derive_key_pair
+
+MAGIC = b'FMKSTOR1'
+# magic, record count, offset of the names blob, offset of the name index
+HEADER = struct.Struct('<8sIQQ')
+# hashed adv key, private key, advertisement key, name offset in the names blob, name length
+RECORD = struct.Struct('<32s28s28sIH')
+NAME_INDEX = struct.Struct('<I')
+
+# generate_keys.py bulk files, records of private key, advertisement key and hashed adv key
+BULK_MAGIC = b'FMKEYS1\n'
+BULK_RECORD_SIZE = 28 + 28 + 32
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+class KeyStore:
+    """
+    Read-only, memory-mapped keystore holding private key, advertisement key, hashed adv key and name per key.
+
+    Records are sorted by hashed adv key, so ``get`` is a binary search over the mapping. A second index holds the
+    records sorted by name for ``by_name_prefix``. Nothing is parsed up front, opening a store of any size costs
+    one mmap. Entries are returned as ``(hashed adv key, private key, advertisement key, name)`` in base64.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self._names_offset, self._name_index_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} is not a keystore")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _hash_at(self, index: int) -> bytes:
+        offset = HEADER.size + index * RECORD.size
+        return self._mm[offset:offset + 32]
+
+    def _entry(self, index: int) -> (str, str, str, str):
+        hashed, private, public, name_offset, name_length = RECORD.unpack_from(
+            self._mm, HEADER.size + index * RECORD.size)
+        start = self._names_offset + name_offset
+        return _b64(hashed), _b64(private), _b64(public), self._mm[start:start + name_length].decode('utf-8')
+
+    def _name_at(self, position: int) -> str:
+        index = NAME_INDEX.unpack_from(self._mm, self._name_index_offset + position * NAME_INDEX.size)[0]
+        return self._entry(index)[3]
+
+    def get(self, hashed_adv_key: str):
+        # Returns the entry of a base64 hashed adv key, or None
+        try:
+            target = base64.b64decode(hashed_adv_key)
+        except ValueError:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._hash_at(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._hash_at(low) == target:
+            return self._entry(low)
+        return None
+
+    def by_name_prefix(self, prefix: str):
+        # Yields every entry whose name starts with prefix, in name order
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name_at(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        for position in range(low, self.count):
+            index = NAME_INDEX.unpack_from(self._mm, self._name_index_offset + position * NAME_INDEX.size)[0]
+            entry = self._entry(index)
+            if not entry[3].startswith(prefix):
+                break
+            yield entry
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self._entry(index)
+
+    def close(self):
+        self._mm.close()
+
+
+class WatchedKeyStore:
+    """
+    The KeyStore at ``path``, reopened once the file was replaced, as request_reports.py and generate_keys.py do
+    when they rebuild it. The file is checked at most every ``check_interval`` seconds. ``get`` answers None while
+    there is no store.
+    """
+
+    def __init__(self, path: str, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._store = None
+        self._signature = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return self._store
+        self._checked = now
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+        if signature != self._signature:
+            try:
+                store = KeyStore(self.path) if signature is not None else None
+            except (OSError, ValueError) as e:
+                logging.error(f"Keeping the previous keystore, {self.path} could not be opened: {e}")
+                return self._store
+            if self._store is not None:
+                self._store.close()
+            self._store, self._signature = store, signature
+            if store is not None:
+                logging.info(f"Opened {self.path} with {len(store)} keys")
+        return self._store
+
+    def get(self, hashed_adv_key: str):
+        with self._lock:
+            store = self._current()
+            return store.get(hashed_adv_key) if store is not None else None
+
+    def close(self):
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+            self._store = self._signature = self._checked = None
+
+
+def write_keystore(path: str, entries) -> int:
+    """
+    Write ``entries`` of (hashed adv key, private key, advertisement key, name), all keys in base64, into a new
+    keystore at ``path``. Later entries replace earlier ones with the same hashed adv key. Returns the key count.
+    """
+    records = {}
+    for hashed, private, public, name in entries:
+        records[base64.b64decode(hashed)] = (base64.b64decode(private), base64.b64decode(public),
+                                             name.encode('utf-8'))
+    hashes = sorted(records)
+
+    names = bytearray()
+    packed = bytearray()
+    for hashed in hashes:
+        private, public, name = records[hashed]
+        packed += RECORD.pack(hashed, private, public, len(names), len(name))
+        names += name
+    name_index = sorted(range(len(hashes)), key=lambda index: records[hashes[index]][2])
+
+    names_offset = HEADER.size + len(packed)
+    name_index_offset = names_offset + len(names)
+    # Write next to the target and rename, readers never map a half written store
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(hashes), names_offset, name_index_offset))
+        f.write(packed)
+        f.write(names)
+        f.write(b''.join(NAME_INDEX.pack(index) for index in name_index))
+    os.replace(temp_path, path)
+    return len(hashes)
+
+
+def read_keys_file(path: str):
+    # Returns (hashed adv key, private key, advertisement key) from a generate_keys.py .keys file, or None
+    keys = {}
+    with open(path) as f:
+        for line in f:
+            key = line.rstrip('\n').split(': ')
+            if len(key) == 2:
+                keys[key[0]] = key[1]
+    if keys.get('Private key') and keys.get('Hashed adv key'):
+        return keys['Hashed adv key'], keys['Private key'], keys.get('Advertisement key', '')
+    return None
+
+
+def read_bulk_file(path: str):
+    # Yields (hashed adv key, private key, advertisement key, name) from a generate_keys.py bulk file,
+    # named <file name>_<hash prefix> the way .keys files are
+    stem = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'rb') as f:
+        if f.read(len(BULK_MAGIC)) != BULK_MAGIC:
+            raise ValueError(f"{path} is not a bulk key file")
+        while True:
+            record = f.read(BULK_RECORD_SIZE)
+            if len(record) < BULK_RECORD_SIZE:
+                break
+            hashed = _b64(record[56:88])
+            yield hashed, _b64(record[0:28]), _b64(record[28:56]), f"{stem}_{hashed[:7]}"
+
+
+def keystore_outdated(directory: str, path: str) -> bool:
+    # True when there is no keystore at path, or a .keys or bulk file in directory changed after it was built
+    if not os.path.exists(path):
+        return True
+    built = os.path.getmtime(path)
+    keyfiles = glob.glob(os.path.join(directory, '*.keys')) + glob.glob(os.path.join(directory, '*.bin'))
+    return any(os.path.getmtime(keyfile) > built for keyfile in keyfiles)
+
+
+def import_keys(directory: str, path: str) -> int:
+    """
+    Build the keystore at ``path`` from every .keys and bulk .bin file in ``directory``, names are the .keys file
+    names without extension. Returns the key count.
+    """
+    def entries():
+        for keyfile in sorted(glob.glob(os.path.join(directory, '*.keys'))):
+            keys = read_keys_file(keyfile)
+            if keys is None:
+                print(f"Couldn't find key pair in {keyfile}")
+                continue
+            hashed, private, public = keys
+            try:
+                if not public:
+                    public = derive_key_pair(private)[1]
+                if [len(base64.b64decode(key)) for key in (hashed, private, public)] != [32, 28, 28]:
+                    raise ValueError("unexpected key length")
+            except Exception as e:
+                print(f"Invalid key pair in {keyfile}: {e}")
+                continue
+            yield hashed, private, public, os.path.basename(keyfile)[:-5]
+        for bulkfile in sorted(glob.glob(os.path.join(directory, '*.bin'))):
+            yield from read_bulk_file(bulkfile)
+
+    return write_keystore(path, entries())
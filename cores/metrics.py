@@ -0,0 +1,113 @@
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import CounterMetricFamily
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+# Stages run from well under a millisecond (one decrypt batch, a SQLite write) to the upstream timeout
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _NullMetric:
+    # Accepts every call a metric does, used when prometheus_client is not installed
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+
+if PROMETHEUS_AVAILABLE:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'findmy_stage_seconds', 'Seconds spent per request stage: anisette, upstream, parse, decrypt, sqlite, mqtt',
+        ['stage'], buckets=STAGE_BUCKETS)
+    UPSTREAM_RESPONSES = prometheus_client.Counter(
+        'findmy_upstream_responses', 'Responses of the report fetch endpoint by HTTP status, timeout or error',
+        ['status'])
+    REPORTS_FETCHED = prometheus_client.Counter('findmy_reports_fetched', 'Encrypted reports received from upstream')
+    REPORTS_DECRYPTED = prometheus_client.Counter('findmy_reports_decrypted', 'Reports decrypted successfully')
+    REPORTS_FAILED = prometheus_client.Counter(
+        'findmy_reports_failed', 'Reports that could not be decrypted, by reason: malformed or decrypt', ['reason'])
+    MQTT_PUBLISHES = prometheus_client.Counter(
+        'findmy_mqtt_publishes', 'MQTT publish outcomes: published or failed', ['result'])
+    ACCOUNT_REQUESTS = prometheus_client.Counter(
+        'findmy_account_requests', 'Upstream requests per search party account by outcome: ok, throttled, '
+        'unauthorized or error', ['account', 'outcome'])
+    ACCOUNT_EJECTIONS = prometheus_client.Counter(
+        'findmy_account_ejections', 'Times a search party account was taken out of rotation, by reason',
+        ['account', 'reason'])
+else:
+    STAGE_SECONDS = UPSTREAM_RESPONSES = REPORTS_FETCHED = REPORTS_DECRYPTED = REPORTS_FAILED = MQTT_PUBLISHES = \
+        ACCOUNT_REQUESTS = ACCOUNT_EJECTIONS = _NullMetric()
+
+
+@contextmanager
+def stage_timer(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+# stats() keys of the caches that count as lookups, and the result label they are exported under
+_CACHE_RESULTS = {'hits': 'hit', 'db_hits': 'db_hit', 'coalesced': 'coalesced', 'misses': 'miss'}
+
+
+class _CacheCollector:
+    # The caches keep their own hit and miss counters, they are read on scrape instead of counted twice
+    def __init__(self):
+        self.caches = {}
+
+    def collect(self):
+        family = CounterMetricFamily('findmy_cache_lookups', 'Cache lookups by cache and result: hit, db_hit, '
+                                     'coalesced or miss', labels=['cache', 'result'])
+        for name, stats in list(self.caches.items()):
+            for key, value in stats().items():
+                if key in _CACHE_RESULTS:
+                    family.add_metric([name, _CACHE_RESULTS[key]], value)
+        yield family
+
+
+_cache_collector = None
+
+
+def register_cache(name: str, stats):
+    """
+    Export the hit and miss counts of a cache, ``stats`` is a zero-argument callable returning a dict with hits,
+    misses and optionally db_hits or coalesced, like the ``stats()`` methods of the caches in cores.
+    """
+    global _cache_collector
+    if not PROMETHEUS_AVAILABLE:
+        return
+    if _cache_collector is None:
+        _cache_collector = _CacheCollector()
+        prometheus_client.REGISTRY.register(_cache_collector)
+    _cache_collector.caches[name] = stats
+
+
+def render() -> (bytes, str):
+    # The exposition of every registered metric and its content type
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Every worker process writes its samples to that directory, they are summed here. Cache lookups are only
+        # known to the process answering.
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        if _cache_collector is not None:
+            registry.register(_cache_collector)
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def write_textfile(path: str):
+    # For one-shot scripts, in the format node_exporter's textfile collector reads
+    prometheus_client.write_to_textfile(path, prometheus_client.REGISTRY)
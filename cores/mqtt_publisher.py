@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+try:
+    # paho-mqtt 2.x requires choosing the callback API, 1.x has no such argument
+    _CLIENT_ARGS = (mqtt.CallbackAPIVersion.VERSION2,)
+except AttributeError:
+    _CLIENT_ARGS = ()
+
+
+class _BrokerConnection:
+    """
+    One long-lived client for a (server, port, username, TLS) tuple. paho's network thread keeps the connection
+    alive and reconnects with exponential backoff between ``min_delay`` and ``max_delay`` seconds.
+    """
+
+    def __init__(self, server: str, port: int, username: str, password: str, tls: bool, ca_certs: str = None,
+                 keepalive: int = 60, min_delay: int = 1, max_delay: int = 60, client_id_suffix: str = ""):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.last_used = time.monotonic()
+        self.connected = threading.Event()
+        self.client = mqtt.Client(*_CLIENT_ARGS, client_id=username + client_id_suffix)
+        self.client.username_pw_set(username, password)
+        if tls:
+            self.client.tls_set(ca_certs=ca_certs)
+        self.client.reconnect_delay_set(min_delay=min_delay, max_delay=max_delay)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.connect_async(server, port, keepalive=keepalive)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, *args):
+        if reason_code == 0:
+            logging.info(f"MQTT connected to {self.server}:{self.port} as {self.username}")
+            self.connected.set()
+        else:
+            logging.error(f"MQTT connection to {self.server}:{self.port} refused: {reason_code}")
+
+    def _on_disconnect(self, client, userdata, *args):
+        if self.connected.is_set():
+            logging.warning(f"MQTT disconnected from {self.server}:{self.port}, reconnecting")
+        self.connected.clear()
+
+    def close(self):
+        self.connected.clear()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class MqttPublisher:
+    """
+    Pool of persistent MQTT connections, one per (server, port, username, TLS) tuple.
+
+    ``publish_many`` sends every message of a batch with QoS 1 before waiting, so the acknowledgements of all
+    brokers are awaited together rather than one connection and round trip per message. Connections unused for
+    ``idle_timeout`` seconds are closed on the next batch. Clients identify as their MQTT username followed by
+    ``client_id_suffix``, brokers drop the older of two connections with the same client id, so processes
+    publishing side by side need distinct suffixes.
+    """
+
+    def __init__(self, ca_certs: str = None, connect_timeout: float = 10.0, ack_timeout: float = 10.0,
+                 idle_timeout: float = 3600.0, min_delay: int = 1, max_delay: int = 60, client_id_suffix: str = ""):
+        self.ca_certs = ca_certs
+        self.connect_timeout = connect_timeout
+        self.ack_timeout = ack_timeout
+        self.idle_timeout = idle_timeout
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.client_id_suffix = client_id_suffix
+        self.published = 0
+        self.failed = 0
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, server: str, port: int, username: str, password: str, tls: bool) -> _BrokerConnection:
+        key = (server, int(port), username, bool(tls))
+        connection = self._connections.get(key)
+        if connection is not None and connection.password != password:
+            # Credentials were updated through KeyToMonitor, log in again
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = _BrokerConnection(server, int(port), username, password, bool(tls), ca_certs=self.ca_certs,
+                                           min_delay=self.min_delay, max_delay=self.max_delay,
+                                           client_id_suffix=self.client_id_suffix)
+            self._connections[key] = connection
+        connection.last_used = time.monotonic()
+        return connection
+
+    def _close_idle(self):
+        now = time.monotonic()
+        for key, connection in list(self._connections.items()):
+            if now - connection.last_used > self.idle_timeout:
+                logging.info(f"Closing idle MQTT connection to {key[0]}:{key[1]}")
+                connection.close()
+                del self._connections[key]
+
+    def publish_many(self, messages: list) -> {}:
+        """
+        Publish ``messages``, dicts with server, port, username, password, tls, topic and payload keys, retained
+        with QoS 1. Blocks until every message is acknowledged or timed out and returns the published/failed counts.
+        """
+        published, failed = 0, 0
+        with self._lock:
+            self._close_idle()
+            pending = []
+            for message in messages:
+                connection = self._connection(message['server'], message['port'], message['username'],
+                                              message['password'], message['tls'])
+                pending.append((message, connection))
+
+            deadline = time.monotonic() + self.connect_timeout
+            infos = []
+            for message, connection in pending:
+                if not connection.connected.wait(max(0.0, deadline - time.monotonic())):
+                    logging.error(f"Publish MQTT Failed: {message['server']}:{message['port']} is not connected")
+                    failed += 1
+                    continue
+                try:
+                    infos.append((message, connection.client.publish(message['topic'], message['payload'],
+                                                                     qos=1, retain=True)))
+                except ValueError as e:
+                    logging.error(f"Publish MQTT Failed for {message['topic']}: {e}")
+                    failed += 1
+
+            deadline = time.monotonic() + self.ack_timeout
+            for message, info in infos:
+                try:
+                    info.wait_for_publish(timeout=max(0.0, deadline - time.monotonic()))
+                except (RuntimeError, ValueError) as e:
+                    logging.error(f"Publish MQTT Failed for {message['topic']}: {e}")
+                if info.is_published():
+                    published += 1
+                else:
+                    logging.error(f"Publish MQTT to {message['server']} not acknowledged: {message['topic']}")
+                    failed += 1
+
+            self.published += published
+            self.failed += failed
+        return {'published': published, 'failed': failed}
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+    def stats(self) -> {}:
+        with self._lock:
+            return {'published': self.published, 'failed': self.failed,
+                    'connections': len(self._connections),
+                    'connected': sum(1 for c in self._connections.values() if c.connected.is_set())}
@@ -9,12 +9,17 @@ import hashlib
 import hmac
 import base64
 import locale
+import threading
+import time
+from collections import deque
 from datetime import datetime
 import srp._pysrp as srp
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from Crypto.Hash import SHA256
 
+from cores.metrics import STAGE_SECONDS
+
 # Created here so that it is consistent
 USER_ID = uuid.uuid4()
 DEVICE_ID = uuid.uuid4()
@@ -27,7 +32,10 @@ srp.no_username_in_x()
 import urllib3
 urllib3.disable_warnings()
 
-ANISETTE_URL = 'http://localhost:6969'  # https://github.com/Dadoum/anisette-v3-server
+# Overridable so that a local stand-in (see harness/) can take the place of each service
+ANISETTE_URL = os.environ.get('FINDMY_ANISETTE_URL', 'http://localhost:6969')  # https://github.com/Dadoum/anisette-v3-server
+GSA_URL = os.environ.get('FINDMY_GSA_URL', 'https://gsa.apple.com')
+SETUP_URL = os.environ.get('FINDMY_SETUP_URL', 'https://setup.icloud.com')
 
 def icloud_login_mobileme(username='', password='', second_factor='sms'):
     if not username:
@@ -59,7 +67,7 @@ def icloud_login_mobileme(username='', password='', second_factor='sms'):
     headers.update(generate_anisette_headers())
 
     r = requests.post(
-        "https://setup.icloud.com/setup/iosbuddy/loginDelegates",
+        f"{SETUP_URL}/setup/iosbuddy/loginDelegates",
         auth=(username, pet),
         data=data,
         headers=headers,
@@ -146,7 +154,7 @@ def gsa_authenticated_request(parameters):
     }
 
     resp = requests.post(
-        "https://gsa.apple.com/grandslam/GsService2",
+        f"{GSA_URL}/grandslam/GsService2",
         headers=headers,
         data=plist.dumps(body),
         verify=False,
@@ -168,8 +176,34 @@ def generate_cpd():
     cpd.update(generate_anisette_headers())
     return cpd
 
-def generate_anisette_headers():
-    try:
+class AnisetteProvider:
+    # Keeps the ADI instance (or an HTTP session to the anisette server) warm and reuses the OTP headers
+    # for `validity` seconds, optionally refreshing them from a background thread before they expire.
+    def __init__(self, url=ANISETTE_URL, validity=20.0, prefetch_interval=5.0):
+        self.url = url
+        self.validity = validity
+        self.prefetch_interval = prefetch_interval
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.latencies = deque(maxlen=512)
+        self._adi = None
+        self._session = None
+        self._otp_headers = None
+        self._fetched_at = 0.0
+        # _lock guards the cached headers, _fetch_lock the ADI instance or session while a fetch runs
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        try:
+            import pyprovision  # noqa: F401
+            self._use_pyprovision = True
+        except ImportError:
+            self._use_pyprovision = False
+            print(f'pyprovision is not installed, querying {self.url} for an anisette server')
+
+    def _load_adi(self):
         import pyprovision
         from ctypes import c_ulonglong
         import secrets
@@ -189,14 +223,108 @@ def generate_anisette_headers():
             print("provisioning...")
             provisioning_session = pyprovision.ProvisioningSession(adi, device)
             provisioning_session.provision(dsid)
-        otp = adi.request_otp(dsid)
-        a = {"X-Apple-I-MD": base64.b64encode(bytes(otp.one_time_password)).decode(), "X-Apple-I-MD-M": base64.b64encode(bytes(otp.machine_identifier)).decode()}
-    except ImportError:
-        print(f'pyprovision is not installed, querying {ANISETTE_URL} for an anisette server')
-        h = json.loads(requests.get(ANISETTE_URL, timeout=5).text)
-        a = {"X-Apple-I-MD": h["X-Apple-I-MD"], "X-Apple-I-MD-M": h["X-Apple-I-MD-M"]}
-    a.update(generate_meta_headers(user_id=USER_ID, device_id=DEVICE_ID))
-    return a
+        return adi, dsid
+
+    def _fetch_otp_headers(self):
+        started = time.monotonic()
+        if self._use_pyprovision:
+            if self._adi is None:
+                self._adi = self._load_adi()
+            adi, dsid = self._adi
+            otp = adi.request_otp(dsid)
+            a = {"X-Apple-I-MD": base64.b64encode(bytes(otp.one_time_password)).decode(), "X-Apple-I-MD-M": base64.b64encode(bytes(otp.machine_identifier)).decode()}
+        else:
+            if self._session is None:
+                self._session = requests.Session()
+            h = json.loads(self._session.get(self.url, timeout=5).text)
+            a = {"X-Apple-I-MD": h["X-Apple-I-MD"], "X-Apple-I-MD-M": h["X-Apple-I-MD-M"]}
+        self.fetches += 1
+        self.latencies.append(time.monotonic() - started)
+        STAGE_SECONDS.labels('anisette').observe(self.latencies[-1])
+        return a
+
+    def _refresh(self):
+        # Called with _lock held, by a request that found no valid headers to use
+        with self._fetch_lock:
+            a = self._fetch_otp_headers()
+        self._otp_headers = a
+        self._fetched_at = time.monotonic()
+        return a
+
+    def headers(self):
+        with self._lock:
+            if self._otp_headers is not None and time.monotonic() - self._fetched_at < self.validity:
+                self.hits += 1
+                a = dict(self._otp_headers)
+            else:
+                self.misses += 1
+                a = dict(self._refresh())
+        # Meta headers carry the client time, so they are generated for every request
+        a.update(generate_meta_headers(user_id=USER_ID, device_id=DEVICE_ID))
+        return a
+
+    def _prefetch_loop(self):
+        while not self._stop.wait(self.prefetch_interval):
+            with self._lock:
+                if self._otp_headers is not None and time.monotonic() - self._fetched_at < self.validity - self.prefetch_interval:
+                    continue
+            # Fetch without holding _lock, requests keep using the current headers meanwhile
+            try:
+                with self._fetch_lock:
+                    a = self._fetch_otp_headers()
+            except Exception as e:
+                print(f'Anisette prefetch failed: {e}')
+                continue
+            with self._lock:
+                self._otp_headers = a
+                self._fetched_at = time.monotonic()
+
+    def start_prefetch(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._prefetch_loop, name="anisette-prefetch", daemon=True)
+            self._thread.start()
+
+    def stop_prefetch(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            age = time.monotonic() - self._fetched_at if self._otp_headers is not None else None
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else None
+        return {"hits": self.hits, "misses": self.misses, "fetches": self.fetches,
+                "latency_p50_ms": percentile(0.5), "latency_p95_ms": percentile(0.95),
+                "latency_max_ms": latencies[-1] * 1000 if latencies else None, "headers_age_s": age}
+
+
+_anisette_provider = None
+_anisette_provider_lock = threading.Lock()
+
+def get_anisette_provider():
+    # Created on first use so importing this module never touches pyprovision or the anisette server
+    global _anisette_provider
+    with _anisette_provider_lock:
+        if _anisette_provider is None:
+            _anisette_provider = AnisetteProvider(url=ANISETTE_URL)
+        return _anisette_provider
+
+def set_anisette_url(url):
+    # Points the provider at another anisette server, the headers fetched from the previous one are dropped
+    global ANISETTE_URL
+    ANISETTE_URL = url
+    with _anisette_provider_lock:
+        if _anisette_provider is not None:
+            with _anisette_provider._lock:
+                _anisette_provider.url = url
+                _anisette_provider._otp_headers = None
+
+def generate_anisette_headers():
+    return get_anisette_provider().headers()
 
 def generate_meta_headers(serial="0", user_id=uuid.uuid4(), device_id=uuid.uuid4()):
     return {
@@ -257,7 +385,7 @@ def trusted_second_factor(dsid, idms_token):
     # We don't care about the response, it's just some HTML with a form for entering the code
     # Easier to just use a text prompt
     requests.get(
-        "https://gsa.apple.com/auth/verify/trusteddevice",
+        f"{GSA_URL}/auth/verify/trusteddevice",
         headers=headers,
         verify=False,
         timeout=10,
@@ -269,7 +397,7 @@ def trusted_second_factor(dsid, idms_token):
 
     # Send the 2FA code to Apple
     resp = requests.get(
-        "https://gsa.apple.com/grandslam/GsService2/validate",
+        f"{GSA_URL}/grandslam/GsService2/validate",
         headers=headers,
         verify=False,
         timeout=10,
@@ -304,7 +432,7 @@ def sms_second_factor(dsid, idms_token):
     # We don't care about the response, it's just some HTML with a form for entering the code
     # Easier to just use a text prompt
     t = requests.put(
-        "https://gsa.apple.com/auth/verify/phone/",
+        f"{GSA_URL}/auth/verify/phone/",
         json=body,
         headers=headers,
         verify=False,
@@ -317,7 +445,7 @@ def sms_second_factor(dsid, idms_token):
 
     # Send the 2FA code to Apple
     resp = requests.post(
-        "https://gsa.apple.com/auth/verify/phone/securitycode",
+        f"{GSA_URL}/auth/verify/phone/securitycode",
         json=body,
         headers=headers,
         verify=False,
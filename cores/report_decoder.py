@@ -0,0 +1,93 @@
+import base64
+import datetime
+import hashlib
+import struct
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from cores.key_cache import private_key_cache
+
+# Report timestamps count seconds from 2001-01-01
+APPLE_EPOCH = 978307200
+
+# Both layouts end with the 57-byte ephemeral key, 10 bytes of cipher text and the 16-byte GCM tag, the header in
+# front is the timestamp and a 1-byte (88-byte reports) or 2-byte (89-byte reports) confidence
+PAYLOAD_TAIL = 57 + 10 + 16
+PAYLOAD_SIZES = (88, 89)
+
+_LOCATION = struct.Struct(">iiBB")
+
+
+def split_payload(data) -> (int, int, memoryview, memoryview):
+    """
+    Split a raw report into (unix timestamp, confidence, ephemeral key, cipher text and tag). The last two are
+    views into ``data``, nothing is copied. Raises ValueError for lengths other than 88 and 89 bytes.
+    """
+    view = memoryview(data)
+    if len(view) not in PAYLOAD_SIZES:
+        raise ValueError(f"Invalid Payload Length {len(view)}")
+    header = len(view) - PAYLOAD_TAIL
+    timestamp = int.from_bytes(view[0:4], byteorder="big") + APPLE_EPOCH
+    confidence = int.from_bytes(view[4:header], byteorder="big")
+    return timestamp, confidence, view[header:header + 57], view[header + 57:]
+
+
+def decode_location(clear_text) -> (float, float, int, int):
+    # (latitude, longitude, horizontal accuracy, status) of a decrypted report
+    latitude, longitude, horizontal_accuracy, status = _LOCATION.unpack_from(clear_text)
+    return latitude / 10000000.0, longitude / 10000000.0, horizontal_accuracy, status
+
+
+def _decrypt(data, private_key: ec.EllipticCurvePrivateKey) -> {}:
+    timestamp, confidence, eph_key_bytes, encrypted = split_payload(data)
+    # cryptography only accepts bytes for the point, the one copy of the whole decode
+    eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), bytes(eph_key_bytes))
+    digest = hashlib.sha256(private_key.exchange(ec.ECDH(), eph_key))
+    digest.update(b'\x00\x00\x00\x01')
+    digest.update(eph_key_bytes)
+    symmetric_key = digest.digest()
+    # AES-GCM with the first 16 bytes as key and the last 16 as IV, the tag follows the cipher text
+    clear_text = AESGCM(symmetric_key[:16]).decrypt(symmetric_key[16:], encrypted, None)
+    latitude, longitude, horizontal_accuracy, status = decode_location(clear_text)
+    return {'timestamp': timestamp, 'isodatetime': datetime.datetime.fromtimestamp(timestamp).isoformat(),
+            'lat': latitude, 'lon': longitude, 'confidence': confidence, 'status': status,
+            'horizontal_accuracy': horizontal_accuracy, 'decrypt_success': True, 'fail_reason': ''}
+
+
+def _raw(payload):
+    # Payloads arrive base64 encoded from Apple, raw bytes-like objects are used as they are
+    return base64.b64decode(payload) if isinstance(payload, str) else payload
+
+
+def decrypt_report(payload, private_key: str) -> {}:
+    """
+    Decrypt one report, ``payload`` in base64 or as raw bytes, bytearray or memoryview, with the base64 private
+    key. Reports of an unknown length are answered with decrypt_success False, decryption errors are raised.
+    """
+    data = _raw(payload)
+    if len(data) not in PAYLOAD_SIZES:
+        return {'decrypt_success': False, 'fail_reason': 'Invalid Payload Length'}
+    return _decrypt(data, private_key_cache.get(private_key))
+
+
+def decrypt_reports(payloads, private_key: str) -> list:
+    """
+    Decrypt many reports of one private key, the key is derived once for the whole batch. Results are in the
+    order of ``payloads``, a report that fails is answered with decrypt_success False and the reason.
+    """
+    try:
+        key = private_key_cache.get(private_key)
+    except Exception as e:
+        return [{'decrypt_success': False, 'fail_reason': f"Decrypt Failed: {type(e).__name__}"} for _ in payloads]
+    results = []
+    for payload in payloads:
+        try:
+            data = _raw(payload)
+            if len(data) not in PAYLOAD_SIZES:
+                results.append({'decrypt_success': False, 'fail_reason': 'Invalid Payload Length'})
+                continue
+            results.append(_decrypt(data, key))
+        except Exception as e:
+            results.append({'decrypt_success': False, 'fail_reason': f"Decrypt Failed: {type(e).__name__}"})
+    return results
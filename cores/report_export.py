@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+from cores.storage import REPORT_COLUMNS
+
+EXPORT_COLUMNS = [column.strip() for column in REPORT_COLUMNS.split(',')]
+
+
+# Export writers turn pages of report rows, in EXPORT_COLUMNS order, into chunks of the response body:
+# header(), rows() once per page, then footer(). Only the current page is held in memory.
+class CsvExportWriter:
+    media_type = "text/csv"
+    extension = "csv"
+
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def _drain(self) -> str:
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def header(self) -> str:
+        self._writer.writerow(EXPORT_COLUMNS)
+        return self._drain()
+
+    def rows(self, rows: list) -> str:
+        self._writer.writerows(rows)
+        return self._drain()
+
+    def footer(self) -> str:
+        return ""
+
+
+class NdjsonExportWriter:
+    media_type = "application/x-ndjson"
+    extension = "ndjson"
+
+    def header(self) -> str:
+        return ""
+
+    def rows(self, rows: list) -> str:
+        return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), separators=(',', ':')) + "\n" for row in rows)
+
+    def footer(self) -> str:
+        return ""
+
+
+class _ParquetSink(io.RawIOBase):
+    # Write-only file for ParquetWriter, the bytes written so far are taken out after every row group
+    def __init__(self):
+        super().__init__()
+        self._data = bytearray()
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._data += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = bytes(self._data)
+        self._data.clear()
+        return data
+
+
+class ParquetExportWriter:
+    # Every page becomes one row group, the file footer is written by footer()
+    media_type = "application/vnd.apache.parquet"
+    extension = "parquet"
+
+    def __init__(self):
+        self._schema = pyarrow.schema([
+            ("id_short", pyarrow.string()), ("timestamp", pyarrow.int64()), ("datePublished", pyarrow.int64()),
+            ("payload", pyarrow.string()), ("id", pyarrow.string()), ("statusCode", pyarrow.int64()),
+            ("lat", pyarrow.float64()), ("lon", pyarrow.float64()), ("conf", pyarrow.int64())])
+        self._sink = _ParquetSink()
+        self._writer = pyarrow.parquet.ParquetWriter(self._sink, self._schema)
+
+    def header(self) -> bytes:
+        return self._sink.drain()
+
+    def rows(self, rows: list) -> bytes:
+        columns = list(zip(*rows)) if rows else [[] for _ in EXPORT_COLUMNS]
+        self._writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+            schema=self._schema))
+        return self._sink.drain()
+
+    def footer(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "ndjson": NdjsonExportWriter, "parquet": ParquetExportWriter}
@@ -0,0 +1,118 @@
+import json
+
+_WHITESPACE = " \t\r\n"
+# A decode error this close to the buffer end may be a literal, escape or delimiter cut off by the chunk boundary
+_TRUNCATION_SLACK = 8
+
+
+class ReportStreamParser:
+    """
+    Incremental parser for an upstream fetch response, ``{"statusCode": "200", "results": [{...}, ...]}``.
+
+    ``reports()`` yields the elements of the top-level ``results`` array one at a time while the file is read in
+    chunks of ``chunk_size``, so only the report being decoded is held in memory. Every other top-level field is
+    collected into ``fields`` as it is passed, ``fields`` is complete once ``reports()`` is exhausted.
+    Malformed input raises ValueError.
+    """
+
+    def __init__(self, fileobj, chunk_size: int = 64 * 1024, encoding: str = "utf-8"):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.fields = {}
+        self.has_results = False
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._pending = b""
+
+    def _read(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            if self._pending:
+                raise ValueError("Truncated UTF-8 sequence at end of input")
+            return False
+        if isinstance(chunk, bytes):
+            # Keep a multi-byte character split across chunks for the next read
+            chunk = self._pending + chunk
+            try:
+                text = chunk.decode(self.encoding)
+                self._pending = b""
+            except UnicodeDecodeError as e:
+                if len(chunk) - e.start > 3:
+                    raise ValueError(f"Invalid {self.encoding} input") from e
+                text = chunk[:e.start].decode(self.encoding)
+                self._pending = chunk[e.start:]
+        else:
+            text = chunk
+        # Drop the consumed prefix so the buffer stays around one chunk long
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                raise ValueError("Unexpected end of JSON input")
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self._pos}, found '{self._buffer[self._pos]}'")
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as e:
+                # Read more only for a value cut off at the buffer end, not to buffer the rest of a bad upload
+                truncated = e.msg.startswith("Unterminated string") or len(self._buffer) - e.pos <= _TRUNCATION_SLACK
+                if truncated and self._read():
+                    continue
+                raise ValueError(f"Invalid JSON value at offset {self._pos}: {e.msg}")
+            # A number or literal ending exactly at the buffer end may continue in the next chunk
+            if end == len(self._buffer) and self._read():
+                continue
+            self._pos = end
+            return value
+
+    def reports(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError("Expected an object key")
+            self._expect(":")
+            if key == "results":
+                self._expect("[")
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._peek() == ",":
+                            self._pos += 1
+                            continue
+                        self._expect("]")
+                        break
+                self.has_results = True
+            else:
+                self.fields[key] = self._value()
+
+            if self._peek() == ",":
+                self._pos += 1
+                continue
+            self._expect("}")
+            return
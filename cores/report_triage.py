@@ -0,0 +1,110 @@
+import binascii
+from collections import Counter
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+from cores.report_decoder import APPLE_EPOCH
+
+KEEP = "keep"
+MALFORMED = "malformed"
+OUT_OF_WINDOW = "out_of_window"
+DUPLICATE = "duplicate"
+
+# Longest payload format, 89 bytes carry a 2-byte confidence and shift the rest by one
+_WIDTH = 89
+
+
+def _decode(payloads: list) -> list:
+    raw = []
+    for payload in payloads:
+        try:
+            raw.append(binascii.a2b_base64(payload))
+        except (binascii.Error, TypeError, ValueError):
+            raw.append(b"")
+    return raw
+
+
+def _triage_numpy(raw: list, ids, start, end, dedupe) -> {}:
+    count = len(raw)
+    lengths = np.fromiter(map(len, raw), dtype=np.int32, count=count)
+    # Every payload padded or cut to 89 bytes, one row each, so the header fields can be read column-wise
+    buffer = np.frombuffer(b"".join(data[:_WIDTH].ljust(_WIDTH, b"\0") for data in raw),
+                           dtype=np.uint8).reshape(count, _WIDTH)
+    is_89 = lengths == 89
+
+    timestamps = np.ascontiguousarray(buffer[:, :4]).view(">u4").ravel().astype(np.int64) + APPLE_EPOCH
+    confidences = np.where(is_89, (buffer[:, 4].astype(np.int32) << 8) | buffer[:, 5], buffer[:, 4])
+    # The ephemeral key is an uncompressed SECP224R1 point, 0x04 followed by the coordinates
+    point_prefix = np.where(is_89, buffer[:, 6], buffer[:, 5])
+
+    malformed = ~(((lengths == 88) | is_89) & (point_prefix == 4))
+    out_of_window = np.zeros(count, dtype=bool)
+    if start is not None:
+        out_of_window |= timestamps < start
+    if end is not None:
+        out_of_window |= timestamps > end
+    out_of_window &= ~malformed
+
+    duplicate = np.zeros(count, dtype=bool)
+    candidates = np.flatnonzero(~malformed & ~out_of_window)
+    if dedupe and len(candidates) > 1:
+        key_index = {}
+        keys = np.fromiter((key_index.setdefault(key, len(key_index)) for key in ids), dtype="<u4", count=count) \
+            if ids is not None else np.zeros(count, dtype="<u4")
+        rows = np.ascontiguousarray(np.concatenate(
+            [keys.view(np.uint8).reshape(count, 4), buffer, is_89.astype(np.uint8).reshape(count, 1)], axis=1)[candidates])
+        _, first = np.unique(rows.view(np.dtype((np.void, rows.shape[1]))).ravel(), return_index=True)
+        duplicate[candidates] = True
+        duplicate[candidates[first]] = False
+
+    status = np.full(count, KEEP, dtype=object)
+    status[duplicate] = DUPLICATE
+    status[out_of_window] = OUT_OF_WINDOW
+    status[malformed] = MALFORMED
+    return {'status': status.tolist(), 'timestamp': timestamps.tolist(), 'confidence': confidences.tolist()}
+
+
+def _triage_python(raw: list, ids, start, end, dedupe) -> {}:
+    status, timestamps, confidences = [], [], []
+    seen = set()
+    for index, data in enumerate(raw):
+        timestamp = int.from_bytes(data[0:4], byteorder="big") + APPLE_EPOCH
+        offset = 1 if len(data) == 89 else 0
+        timestamps.append(timestamp)
+        confidences.append(int.from_bytes(data[4:5 + offset], byteorder="big"))
+        if len(data) not in (88, 89) or data[5 + offset] != 4:
+            status.append(MALFORMED)
+        elif (start is not None and timestamp < start) or (end is not None and timestamp > end):
+            status.append(OUT_OF_WINDOW)
+        elif dedupe and ((ids[index] if ids is not None else None), data) in seen:
+            status.append(DUPLICATE)
+        else:
+            seen.add(((ids[index] if ids is not None else None), data))
+            status.append(KEEP)
+    return {'status': status, 'timestamp': timestamps, 'confidence': confidences}
+
+
+def triage_reports(payloads: list, ids: list = None, start: int = None, end: int = None, dedupe: bool = True) -> {}:
+    """
+    Classify base64 ``payloads`` before any ECDH is spent on them.
+
+    Every payload gets a status: ``malformed`` when it is not valid base64 of an 88- or 89-byte report with an
+    uncompressed ephemeral key, ``out_of_window`` when its timestamp (unix seconds) falls outside ``start`` and
+    ``end``, ``duplicate`` when the same payload was already seen for the same entry of ``ids``, otherwise
+    ``keep``. Returns the status, timestamp and confidence lists, aligned with ``payloads``.
+    """
+    if len(payloads) == 0:
+        return {'status': [], 'timestamp': [], 'confidence': []}
+    raw = _decode(payloads)
+    if NUMPY_AVAILABLE:
+        return _triage_numpy(raw, ids, start, end, dedupe)
+    return _triage_python(raw, ids, start, end, dedupe)
+
+
+def triage_counts(triage: {}) -> {}:
+    counts = Counter(triage['status'])
+    return {status: counts.get(status, 0) for status in (KEEP, MALFORMED, OUT_OF_WINDOW, DUPLICATE)}
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+
+
+class SyncScheduler:
+    """
+    Background sync loop with an adaptive polling interval per tag.
+
+    ``sync`` is a coroutine function taking the set of due tags and returning ``{tag: new report count}`` for the
+    tags it synced. A tag that produced new reports has its interval halved, a tag that produced none has it grown
+    by ``backoff``, always within ``min_interval`` and ``max_interval`` seconds. Busy tags therefore refresh
+    quickly while dormant ones settle at ``max_interval``. ``publish``, when given, is awaited with the tags that
+    received new reports.
+
+    Several processes may share one database. ``leader``, when given, is called in a thread before every background
+    run, which is skipped unless it returns True, so only one process syncs on schedule. It is called again every
+    ``min_interval`` seconds while the run lasts, so a leader renewing a lease keeps it through long syncs.
+    ``synced_at`` returns the unix time of each tag's last successful sync by any process, manual triggers then
+    skip those tags as well.
+    """
+
+    def __init__(self, sync, tags, publish=None, min_interval: float = 60.0, max_interval: float = 3600.0,
+                 backoff: float = 1.5, leader=None, synced_at=None):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.runs = 0
+        self._sync = sync
+        self._tags = tags
+        self._publish = publish
+        self._leader = leader
+        self._synced_at = synced_at
+        self.leading = leader is None
+        self._intervals = {}
+        self._next_due = {}
+        self._last_sync = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def _schedule(self, tag, new_reports: int, now: float):
+        interval = self._intervals.get(tag, self.min_interval)
+        if new_reports > 0:
+            interval = max(self.min_interval, interval / 2)
+        else:
+            interval = min(self.max_interval, interval * self.backoff)
+        self._intervals[tag] = interval
+        self._next_due[tag] = now + interval
+
+    async def run_due(self, force: bool = False, publish: bool = True) -> {}:
+        """
+        Sync the tags that are due. With ``force`` every tag not synced within ``min_interval`` is due, which is
+        what a manual trigger uses. Returns the number of tags due, synced and the new reports found.
+        """
+        async with self._lock:
+            now = time.monotonic()
+            tags = set(self._tags())
+            # Forget tags removed since the last run
+            for tag in set(self._next_due) - tags:
+                self._intervals.pop(tag, None)
+                self._next_due.pop(tag, None)
+                self._last_sync.pop(tag, None)
+
+            if force:
+                due = {tag for tag in tags if now - self._last_sync.get(tag, -self.min_interval) >= self.min_interval}
+                if self._synced_at is not None:
+                    synced_at = self._synced_at()
+                    due = {tag for tag in due if time.time() - (synced_at.get(tag) or 0) >= self.min_interval}
+            else:
+                due = {tag for tag in tags if self._next_due.get(tag, 0) <= now}
+            if not due:
+                return {"due": 0, "synced": 0, "new": 0}
+
+            self.runs += 1
+            try:
+                synced = await self._sync(due)
+            except Exception as e:
+                logging.error(f"Scheduled sync failed: {e}", exc_info=True)
+                synced = {}
+
+            for tag in due:
+                self._last_sync[tag] = now
+                if tag in synced:
+                    self._schedule(tag, synced[tag], now)
+                else:
+                    # Upstream failed for this tag, retry at the same pace
+                    self._next_due[tag] = now + self._intervals.get(tag, self.min_interval)
+
+            changed = {tag for tag, new_reports in synced.items() if new_reports > 0}
+            if publish and changed and self._publish is not None:
+                try:
+                    await self._publish(changed)
+                except Exception as e:
+                    logging.error(f"Scheduled publish failed: {e}", exc_info=True)
+            return {"due": len(due), "synced": len(synced), "new": sum(synced.values())}
+
+    def _sleep_time(self) -> float:
+        if not self._next_due:
+            return self.min_interval
+        return min(max(1.0, min(self._next_due.values()) - time.monotonic()), self.min_interval)
+
+    async def _lead(self) -> bool:
+        if self._leader is None:
+            return True
+        leading = await asyncio.to_thread(self._leader)
+        if leading != self.leading:
+            logging.info(f"Scheduler {'took over' if leading else 'handed over'} scheduled syncs")
+            self.leading = leading
+        return leading
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.min_interval)
+            try:
+                await self._lead()
+            except Exception as e:
+                logging.error(f"Scheduler lease renewal failed: {e}", exc_info=True)
+
+    async def _loop(self):
+        while True:
+            try:
+                if not await self._lead():
+                    await asyncio.sleep(self.min_interval)
+                    continue
+                # Keep leading while the sync and publish run, however long they take
+                renew = asyncio.create_task(self._renew()) if self._leader is not None else None
+                try:
+                    result = await self.run_due()
+                finally:
+                    if renew is not None:
+                        renew.cancel()
+                if result["due"]:
+                    logging.info(f"Scheduled sync: {result['synced']} of {result['due']} due tag(s) synced, "
+                                 f"{result['new']} new report(s)")
+            except Exception as e:
+                logging.error(f"Scheduler run failed: {e}", exc_info=True)
+            await asyncio.sleep(self._sleep_time())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> {}:
+        now = time.monotonic()
+        intervals = sorted(self._intervals.values())
+        return {'running': self._task is not None, 'leading': self.leading, 'runs': self.runs,
+                'tags': len(self._next_due),
+                'min_interval': intervals[0] if intervals else None,
+                'max_interval': intervals[-1] if intervals else None,
+                'next_due_in': max(0.0, min(self._next_due.values()) - now) if self._next_due else None}
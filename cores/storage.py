@@ -0,0 +1,272 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+SCHEMA_VERSION = 5
+
+REPORT_COLUMNS = "id_short, timestamp, datePublished, payload, id, statusCode, lat, lon, conf"
+
+CREATE_TAGS = '''CREATE TABLE IF NOT EXISTS tags (
+        hash_adv_key TEXT, private_key TEXT, friendly_name TEXT, mqtt_server TEXT, mqtt_port INTEGER, mqtt_over_tls BOOLEAN,
+        mqtt_publish_encryption_key TEXT, mqtt_username TEXT, mqtt_userpass TEXT, mqtt_topic TEXT,
+        PRIMARY KEY(private_key,mqtt_server));'''
+
+CREATE_REPORTS = '''CREATE TABLE IF NOT EXISTS reports (
+id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT,
+id TEXT, statusCode INTEGER, lat REAL, lon REAL, conf INTEGER, PRIMARY KEY(id,payload));'''
+
+# Per-tag sync watermarks, synced_until is the end of the last window fetched successfully
+CREATE_SYNC_STATE = '''CREATE TABLE IF NOT EXISTS sync_state (
+hash_adv_key TEXT PRIMARY KEY, last_date_published INTEGER, last_timestamp INTEGER, synced_until INTEGER,
+new_reports INTEGER, duplicate_reports INTEGER);'''
+
+# Private keys are secrets, the table is keyed on their SHA-256 digest, see private_key_digest()
+CREATE_KEY_MAP = '''CREATE TABLE IF NOT EXISTS key_map (
+key_digest BLOB PRIMARY KEY, hash_adv_key TEXT, public_key TEXT) WITHOUT ROWID;'''
+
+# Newest located report per tag, kept current by the trigger below so publishing never scans the report history
+CREATE_LATEST_LOCATION = '''CREATE TABLE IF NOT EXISTS latest_location (
+id TEXT PRIMARY KEY, timestamp INTEGER, datePublished INTEGER, lat REAL, lon REAL, conf INTEGER);'''
+
+UPSERT_LATEST_LOCATION = '''INSERT INTO latest_location (id, timestamp, datePublished, lat, lon, conf) {source}
+    ON CONFLICT(id) DO UPDATE SET timestamp = excluded.timestamp, datePublished = excluded.datePublished,
+    lat = excluded.lat, lon = excluded.lon, conf = excluded.conf
+    WHERE excluded.timestamp >= latest_location.timestamp'''
+
+CREATE_LATEST_LOCATION_TRIGGER = f'''CREATE TRIGGER IF NOT EXISTS reports_latest_location AFTER INSERT ON reports
+WHEN NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL
+BEGIN
+    {UPSERT_LATEST_LOCATION.format(
+        source="VALUES (NEW.id, NEW.timestamp, NEW.datePublished, NEW.lat, NEW.lon, NEW.conf)")};
+END;'''
+
+# Decrypted payloads by digest of (private key, payload), see cores/decrypt_cache.py. Only tag removal looks
+# entries up by id, that is rare enough to go without an index.
+CREATE_DECRYPT_CACHE = '''CREATE TABLE IF NOT EXISTS decrypt_cache (
+key BLOB PRIMARY KEY, id TEXT, timestamp INTEGER, lat REAL, lon REAL, conf INTEGER, status INTEGER,
+horizontal_accuracy INTEGER) WITHOUT ROWID;'''
+
+# Encrypted report responses shared by the web_service workers, see cores/fetch_cache.py
+CREATE_FETCH_CACHE = '''CREATE TABLE IF NOT EXISTS fetch_cache (
+key BLOB PRIMARY KEY, fetched_at REAL, value TEXT) WITHOUT ROWID;'''
+
+# Named leases held by one process at a time, expires is a unix timestamp
+CREATE_LEASES = '''CREATE TABLE IF NOT EXISTS leases (
+name TEXT PRIMARY KEY, owner TEXT, expires REAL);'''
+
+CREATE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS reports_id_timestamp ON reports(id, timestamp);",
+    "CREATE INDEX IF NOT EXISTS tags_hash_adv_key ON tags(hash_adv_key);",
+]
+
+
+# SQLite limits the number of bound parameters, IN (...) lists are queried in slices of this many values
+IN_BATCH_SIZE = 500
+
+
+def private_key_digest(private_key: str) -> bytes:
+    return hashlib.sha256(private_key.encode()).digest()
+
+
+def select_in(conn: sqlite3.Connection, sql: str, values, params: tuple = ()) -> list:
+    # Rows of sql for every value, the "{}" in it becomes the placeholders of one slice and params follow them
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), IN_BATCH_SIZE):
+        batch = values[start:start + IN_BATCH_SIZE]
+        rows.extend(conn.execute(sql.format(','.join('?' * len(batch))), batch + list(params)).fetchall())
+    return rows
+
+
+class ReportStore:
+    """
+    SQLite storage for reports.db.
+
+    The database runs in WAL mode so readers never wait on the writer, and every thread gets its own connection.
+    Opening the store migrates older databases to the current schema, tracked in ``PRAGMA user_version``.
+    """
+
+    def __init__(self, db_path: str, busy_timeout: float = 5.0):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.migrate()
+
+    def open_connection(self) -> sqlite3.Connection:
+        # A connection owned by the caller, for work that may hop between threads such as a streamed export.
+        # The caller closes it.
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Only the owning thread uses the connection, close() may still run elsewhere
+            conn = self.open_connection()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def migrate(self):
+        conn = self.connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another process may have migrated while we waited for the write lock
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
+            self._migrate_reports(conn)
+            if 0 < version < 5:
+                # key_map held plaintext private keys, it is only a memo and gets rebuilt on demand
+                conn.execute("DROP TABLE IF EXISTS key_map")
+            for query in [CREATE_TAGS, CREATE_REPORTS, CREATE_SYNC_STATE, CREATE_KEY_MAP, CREATE_LATEST_LOCATION,
+                          CREATE_LATEST_LOCATION_TRIGGER, CREATE_DECRYPT_CACHE, CREATE_FETCH_CACHE,
+                          CREATE_LEASES] + CREATE_INDEXES:
+                conn.execute(query)
+            if version < 2:
+                self._backfill_latest_location(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        logging.info(f"reports.db migrated from schema {version} to {SCHEMA_VERSION}")
+
+    def _migrate_reports(self, conn: sqlite3.Connection):
+        # Older web_service tables stored lat/lon as TEXT, request_reports.py keyed reports on (id_short, timestamp)
+        columns = conn.execute("PRAGMA table_info(reports)").fetchall()
+        if not columns:
+            return
+        types = {column[1]: column[2].upper() for column in columns}
+        primary_key = [column[1] for column in sorted(columns, key=lambda column: column[5]) if column[5] > 0]
+        if types.get("lat") == "REAL" and types.get("lon") == "REAL" and primary_key == ["id", "payload"]:
+            return
+
+        logging.info("Rebuilding reports table with REAL lat/lon columns")
+        conn.execute("ALTER TABLE reports RENAME TO reports_old")
+        conn.execute(CREATE_REPORTS)
+        conn.execute(f"""INSERT OR IGNORE INTO reports ({REPORT_COLUMNS})
+            SELECT id_short, timestamp, datePublished, payload, id, statusCode,
+            CAST(lat AS REAL), CAST(lon AS REAL), conf FROM reports_old""")
+        conn.execute("DROP TABLE reports_old")
+
+    def _backfill_latest_location(self, conn: sqlite3.Connection):
+        # SQLite takes the bare columns from the row holding MAX(timestamp)
+        logging.info("Backfilling latest_location from reports")
+        conn.execute(UPSERT_LATEST_LOCATION.format(
+            source="SELECT id, MAX(timestamp), datePublished, lat, lon, conf FROM reports "
+                   "WHERE lat IS NOT NULL AND lon IS NOT NULL GROUP BY id"))
+
+    def insert_reports(self, rows: list, replace: bool = False):
+        # rows are tuples in REPORT_COLUMNS order
+        conn = self.connection()
+        with conn:
+            conn.executemany(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO reports ({REPORT_COLUMNS}) "
+                             f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def stored_payloads(self, hash_adv_keys: list, date_published_since: int) -> set:
+        return set(select_in(self.connection(),
+                             "SELECT id, payload FROM reports WHERE id IN ({}) AND datePublished >= ?",
+                             hash_adv_keys, (date_published_since,)))
+
+    def export_reports(self, hash_adv_keys, start: int, end: int, page_size: int = 1000, after: tuple = None,
+                       conn: sqlite3.Connection = None):
+        """
+        Yield pages of stored reports of ``hash_adv_keys`` with ``start <= timestamp <= end``, ordered by id,
+        timestamp and rowid. Rows are ``(rowid,) + REPORT_COLUMNS``. Every page is one keyset query on the
+        reports(id, timestamp) index, resuming after the last row of the previous page. ``after`` is an
+        ``(id, timestamp, rowid)`` position to start behind, as taken from a previously returned row.
+        ``conn`` runs the queries on a connection from ``open_connection`` instead of the thread's own.
+        """
+        conn = conn or self.connection()
+        for hash_key in sorted(set(hash_adv_keys)):
+            if after is not None and hash_key < after[0]:
+                continue
+            position = (after[1], after[2]) if after is not None and hash_key == after[0] else (start, -1)
+            while True:
+                rows = conn.execute(
+                    f"SELECT rowid, {REPORT_COLUMNS} FROM reports WHERE id = ? AND timestamp >= ? AND timestamp <= ? "
+                    f"AND (timestamp, rowid) > (?, ?) ORDER BY timestamp, rowid LIMIT ?",
+                    (hash_key, start, end) + position + (page_size,)).fetchall()
+                if rows:
+                    yield rows
+                if len(rows) < page_size:
+                    break
+                position = (rows[-1][2], rows[-1][0])
+
+    def upsert_tags(self, rows: list):
+        conn = self.connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def tag_private_keys(self) -> {}:
+        return dict(self.connection().execute("SELECT hash_adv_key, private_key FROM tags").fetchall())
+
+    def remove_keys(self, keys):
+        conn = self.connection()
+        with conn:
+            for key in keys:
+                conn.execute("DELETE FROM tags WHERE hash_adv_key = ? OR private_key = ?", (key, key))
+                conn.execute("DELETE FROM reports WHERE id = ?", (key,))
+                conn.execute("DELETE FROM sync_state WHERE hash_adv_key = ?", (key,))
+                conn.execute("DELETE FROM latest_location WHERE id = ?", (key,))
+                conn.execute("DELETE FROM key_map WHERE hash_adv_key = ? OR key_digest = ?",
+                             (key, private_key_digest(key)))
+
+    def latest_locations(self, hash_adv_keys=None) -> list:
+        # One row per registered (tag, MQTT server) that has a located report, optionally only for hash_adv_keys
+        rows = self.connection().execute("""SELECT
+            hash_adv_key, friendly_name, mqtt_server, mqtt_port, lat, lon, timestamp, mqtt_over_tls,
+            mqtt_publish_encryption_key, mqtt_username, mqtt_userpass, mqtt_topic, conf
+            FROM tags JOIN latest_location ON latest_location.id = tags.hash_adv_key""").fetchall()
+        if hash_adv_keys is None:
+            return rows
+        return [row for row in rows if row[0] in hash_adv_keys]
+
+    def synced_until(self) -> {}:
+        return dict(self.connection().execute("SELECT hash_adv_key, synced_until FROM sync_state").fetchall())
+
+    def new_reports_since(self, synced_until: int) -> {}:
+        # New report counts of the tags whose last successful sync ended at or after synced_until
+        return dict(self.connection().execute(
+            "SELECT hash_adv_key, new_reports FROM sync_state WHERE synced_until >= ?", (synced_until,)).fetchall())
+
+    def update_sync_state(self, rows: list):
+        # rows are (hash_adv_key, last_date_published, last_timestamp, synced_until, new_reports, duplicate_reports)
+        conn = self.connection()
+        with conn:
+            conn.executemany("""INSERT INTO sync_state VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(hash_adv_key) DO UPDATE SET
+                last_date_published = MAX(COALESCE(last_date_published, 0), COALESCE(excluded.last_date_published, 0)),
+                last_timestamp = MAX(COALESCE(last_timestamp, 0), COALESCE(excluded.last_timestamp, 0)),
+                synced_until = excluded.synced_until, new_reports = excluded.new_reports,
+                duplicate_reports = excluded.duplicate_reports""", rows)
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        # Take the named lease for ttl seconds, or renew it when owner already holds it. Every process opening the
+        # same reports.db sees the same holder, the lease passes on once its holder stops renewing it.
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute("""INSERT INTO leases VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+                WHERE leases.owner = excluded.owner OR leases.expires < ?""", (name, owner, now + ttl, now))
+            return conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0] == owner
+
+    def release_lease(self, name: str, owner: str):
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from cores.metrics import ACCOUNT_REQUESTS, ACCOUNT_EJECTIONS
+
+# Outcomes of one upstream request made with an account
+OK = "ok"
+THROTTLED = "throttled"
+UNAUTHORIZED = "unauthorized"
+ERROR = "error"
+
+STRATEGIES = ("least_loaded", "round_robin")
+
+
+def outcome_of(status_code: int | None) -> str:
+    # The outcome of an upstream response status, None for requests that got no response at all
+    if status_code is None:
+        return ERROR
+    if status_code in (429, 503):
+        return THROTTLED
+    if status_code in (401, 403):
+        return UNAUTHORIZED
+    return ERROR if status_code >= 400 else OK
+
+
+class Account:
+    """
+    One dsid and search party token, with the health of the requests made with it. The last ``window`` outcomes
+    give the error and throttle rates.
+    """
+
+    def __init__(self, name: str, dsid: str, token: str, window: int = 100):
+        self.name = name
+        self.dsid = dsid
+        self.token = token
+        self.requests = 0
+        self.inflight = 0
+        self.failures = 0
+        self.strikes = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.outcomes = deque(maxlen=window)
+
+    @property
+    def auth(self) -> (str, str):
+        return self.dsid, self.token
+
+    def rate(self, *outcomes) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for outcome in self.outcomes if outcome in outcomes) / len(self.outcomes)
+
+    def stats(self) -> {}:
+        return {'requests': self.requests, 'inflight': self.inflight,
+                'error_rate': self.rate(ERROR, UNAUTHORIZED), 'throttle_rate': self.rate(THROTTLED),
+                'ejections': self.ejections, 'ejected_for': max(0.0, self.ejected_until - time.monotonic())}
+
+
+def read_auth(path: str) -> list:
+    # keys/auth.json holds one {"dsid": ..., "searchPartyToken": ...} object, or a list of them each with an
+    # optional "name"
+    with open(path, "r") as f:
+        entries = json.load(f)
+    return [entries] if isinstance(entries, dict) else entries
+
+
+def save_auth(path: str, dsid, token: str):
+    # Store a login in keys/auth.json, replacing the token of the entry with the same dsid or adding the account.
+    # A single account keeps the original one object format.
+    entries = read_auth(path) if os.path.exists(path) else []
+    for entry in entries:
+        if str(entry['dsid']) == str(dsid):
+            entry.update({'dsid': dsid, 'searchPartyToken': token})
+            break
+    else:
+        entries.append({'dsid': dsid, 'searchPartyToken': token})
+    with open(path, "w") as f:
+        json.dump(entries[0] if len(entries) == 1 else entries, f)
+
+
+def load_accounts(path: str) -> list:
+    return [Account(entry.get('name') or f"account{index}", str(entry['dsid']), entry['searchPartyToken'])
+            for index, entry in enumerate(read_auth(path))]
+
+
+class TokenPool:
+    """
+    Search party accounts that upstream requests are spread over.
+
+    ``acquire`` hands out the healthy account with the fewest requests in flight, or with ``strategy``
+    round_robin the next healthy one in turn, and ``release`` records how the request went. An account is ejected
+    for ``eject_seconds`` when Apple throttles it (429 or 503), rejects its token (401 or 403), or after
+    ``max_failures`` consecutive errors. The time doubles with every ejection in a row, up to
+    ``max_eject_seconds``, and a successful request resets it. With every account ejected, the one due back first
+    is used anyway, requests never fail for lack of an account.
+    """
+
+    def __init__(self, accounts: list, strategy: str = "least_loaded", max_failures: int = 3,
+                 eject_seconds: float = 60.0, max_eject_seconds: float = 1800.0):
+        if not accounts:
+            raise ValueError("TokenPool needs at least one account")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy}, use one of {', '.join(STRATEGIES)}")
+        self.accounts = list(accounts)
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max(eject_seconds, max_eject_seconds)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def acquire(self, exclude=()) -> Account:
+        # An account for one request, other than those in exclude while any remain. Pair with release().
+        with self._lock:
+            now = time.monotonic()
+            candidates = [account for account in self.accounts if account not in exclude] or self.accounts
+            healthy = [account for account in candidates if account.ejected_until <= now]
+            if not healthy:
+                account = min(candidates, key=lambda account: account.ejected_until)
+            elif self.strategy == "round_robin":
+                for offset in range(len(self.accounts)):
+                    index = (self._next + offset) % len(self.accounts)
+                    if self.accounts[index] in healthy:
+                        break
+                account = self.accounts[index]
+                self._next = index + 1
+            else:
+                account = min(healthy, key=lambda account: (account.inflight, account.requests))
+            account.requests += 1
+            account.inflight += 1
+            return account
+
+    def release(self, account: Account, outcome: str):
+        with self._lock:
+            account.inflight -= 1
+            account.outcomes.append(outcome)
+            ACCOUNT_REQUESTS.labels(account.name, outcome).inc()
+            if outcome == OK:
+                account.failures = 0
+                account.strikes = 0
+                return
+            account.failures += 1
+            if outcome in (THROTTLED, UNAUTHORIZED) or account.failures >= self.max_failures:
+                self._eject(account, outcome)
+
+    def _eject(self, account: Account, reason: str):
+        now = time.monotonic()
+        if account.ejected_until > now:
+            # Requests that were already in flight failing as well
+            return
+        seconds = min(self.max_eject_seconds, self.eject_seconds * 2 ** account.strikes)
+        account.ejected_until = now + seconds
+        account.strikes += 1
+        account.ejections += 1
+        account.failures = 0
+        ACCOUNT_EJECTIONS.labels(account.name, reason).inc()
+        logging.warning(f"Search party account {account.name} {reason}, out of rotation for {seconds:.0f} seconds")
+
+    def stats(self) -> {}:
+        with self._lock:
+            return {account.name: account.stats() for account in self.accounts}
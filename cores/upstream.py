@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import os
+
+import httpx
+
+from cores.metrics import UPSTREAM_RESPONSES, stage_timer
+from cores.token_pool import OK, ERROR, outcome_of
+
+try:
+    import h2  # noqa: F401  httpx only negotiates HTTP/2 when the h2 package is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+FETCH_URL = os.environ.get("FINDMY_FETCH_URL", "https://gateway.icloud.com/acsnservice/fetch")
+
+
+class UpstreamError(Exception):
+    # status_code is what the service answers with, upstream_status what Apple answered, if anything
+    def __init__(self, message: str, status_code: int = 502, upstream_status: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.upstream_status = upstream_status
+
+
+class UpstreamClient:
+    """
+    Async client for Apple's acsnservice/fetch endpoint.
+
+    One keep-alive connection pool is shared by every request, HTTP/2 is used when available, each request is
+    bounded by ``timeout`` seconds and at most ``max_concurrency`` requests are in flight at a time. Large key
+    sets are split into searches of at most ``chunk_size`` ids by ``fetch_reports``.
+
+    Requests made without ``auth`` take an account from ``pool``, a cores.token_pool.TokenPool. A request Apple
+    answered with an error status is retried with another account, each account is tried once. Timeouts and
+    connection errors are not retried, they are rarely down to the account.
+    """
+
+    def __init__(self, url: str = FETCH_URL, timeout: float = 30.0, max_concurrency: int = 8,
+                 max_connections: int = 16, http2: bool = HTTP2_AVAILABLE, chunk_size: int = 256, pool=None):
+        self.url = url
+        self.pool = pool
+        self.chunk_size = max(1, chunk_size)
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._client = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections))
+        return self._client
+
+    async def fetch(self, data: {}, auth: (str, str) = None, headers: {} = None) -> {}:
+        if auth is not None or self.pool is None:
+            return await self._post(data, auth, headers)
+
+        tried = []
+        while True:
+            account = self.pool.acquire(exclude=tried)
+            tried.append(account)
+            try:
+                response = await self._post(data, account.auth, headers)
+            except UpstreamError as e:
+                self.pool.release(account, outcome_of(e.upstream_status))
+                if e.upstream_status is None or len(tried) >= len(self.pool):
+                    raise
+                logging.warning(f"Upstream request with account {account.name} failed, retrying with another. {e}")
+                continue
+            self.pool.release(account, OK if response.get("statusCode") == "200" else ERROR)
+            return response
+
+    async def _post(self, data: {}, auth: (str, str), headers: {}) -> {}:
+        async with self._semaphore:
+            try:
+                with stage_timer("upstream"):
+                    r = await self._get_client().post(self.url, auth=auth, headers=headers, json=data)
+            except httpx.TimeoutException:
+                UPSTREAM_RESPONSES.labels("timeout").inc()
+                raise UpstreamError(f"Upstream timed out after {self.timeout} seconds", status_code=504)
+            except httpx.HTTPError as e:
+                UPSTREAM_RESPONSES.labels("error").inc()
+                raise UpstreamError(f"Upstream request failed: {e}")
+
+        logging.debug(f"Upstream responded {r.status_code} over {r.http_version}")
+        UPSTREAM_RESPONSES.labels(str(r.status_code)).inc()
+        if r.status_code >= 400:
+            raise UpstreamError(f"Upstream responded with HTTP {r.status_code}", upstream_status=r.status_code)
+        try:
+            with stage_timer("parse"):
+                return json.loads(r.content.decode(encoding='utf-8'))
+        except ValueError:
+            raise UpstreamError("Upstream response is not valid JSON")
+
+    async def fetch_reports(self, ids: list, start_date: int, end_date: int, auth: (str, str) = None,
+                            headers: {} = None) -> {}:
+        """
+        Fetch reports for ``ids`` between ``start_date`` and ``end_date`` (unix milliseconds), issuing one request
+        per chunk of ids concurrently, spread over the accounts of the pool when no ``auth`` is given. The
+        ``results`` of successful chunks are merged, chunks that failed are listed under ``failedChunks``.
+        UpstreamError is only raised when every chunk failed.
+        """
+        chunks = [ids[start:start + self.chunk_size] for start in range(0, len(ids), self.chunk_size)]
+        if len(chunks) <= 1:
+            return await self.fetch({"search": [{"startDate": start_date, "endDate": end_date, "ids": ids}]},
+                                    auth=auth, headers=headers)
+
+        responses = await asyncio.gather(
+            *(self.fetch({"search": [{"startDate": start_date, "endDate": end_date, "ids": chunk}]},
+                         auth=auth, headers=headers) for chunk in chunks),
+            return_exceptions=True)
+
+        merged = {"statusCode": "200", "results": []}
+        failures = []
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, UpstreamError):
+                failures.append({"ids": chunk, "error": str(response), "status_code": response.status_code})
+            elif isinstance(response, BaseException):
+                raise response
+            elif response.get("statusCode") != "200":
+                failures.append({"ids": chunk, "error": f"Upstream informed an error. {response.get('statusCode')}",
+                                 "status_code": 502})
+            else:
+                merged["results"].extend(response.get("results", []))
+
+        if len(failures) == len(chunks):
+            raise UpstreamError(failures[0]["error"], status_code=failures[0]["status_code"])
+        if failures:
+            logging.warning(f"{len(failures)} of {len(chunks)} upstream chunks failed")
+            merged["failedChunks"] = failures
+        return merged
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -1,26 +1,22 @@
 #!/usr/bin/env python3
 import base64,argparse
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-n', '--nkeys', help='number of keys to generate', type=int, default=1)
-parser.add_argument('-p', '--prefix', help='prefix of the keyfiles')
-parser.add_argument('-y', '--yaml', help='yaml file where to write the list of generated keys')
-parser.add_argument('-v', '--verbose', help='print keys as they are generated', action="store_true")
-args = parser.parse_args()
+# Bulk key files start with BULK_MAGIC, followed by fixed size records of
+# private key (28 bytes), advertisement key (28 bytes) and hashed adv key (32 bytes)
+from cores.keystore import BULK_MAGIC, BULK_RECORD_SIZE as RECORD_SIZE, import_keys
 
-if args.yaml:
-    yaml = open(args.yaml + '.yaml', 'w')
-    yaml.write('  keys:\n')
+# The directory request_reports.py and web_service.py read keys from, wherever this script is run from
+KEYS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'keys')
 
-if not os.path.exists('keys'):
-    os.makedirs('keys')
 
-for i in range(args.nkeys):
+def generate_key(allow_slash):
     while True:
         private_key = ec.generate_private_key(ec.SECP224R1(), default_backend())
         public_key = private_key.public_key()
@@ -28,34 +24,117 @@ for i in range(args.nkeys):
         private_key_bytes = private_key.private_numbers().private_value.to_bytes(28, byteorder='big')
         public_key_bytes = public_key.public_numbers().x.to_bytes(28, byteorder='big')
 
-        private_key_b64 = base64.b64encode(private_key_bytes).decode("ascii")
-        public_key_b64 = base64.b64encode(public_key_bytes).decode("ascii")
-
         public_key_hash = hashes.Hash(hashes.SHA256())
         public_key_hash.update(public_key_bytes)
-        s256_b64 = base64.b64encode(public_key_hash.finalize()).decode("ascii")
+        s256 = public_key_hash.finalize()
+
+        # The hash prefix names the .keys file, re-roll keys that would put a '/' in it
+        if allow_slash or '/' not in base64.b64encode(s256).decode("ascii")[:7]:
+            return private_key_bytes + public_key_bytes + s256
+
+
+def generate_batch(count, allow_slash):
+    # Runs in a pool worker, returns the records of count keys as one bytes object
+    return b''.join(generate_key(allow_slash) for _ in range(count))
+
+
+def split_record(record):
+    private_key_b64 = base64.b64encode(record[0:28]).decode("ascii")
+    public_key_b64 = base64.b64encode(record[28:56]).decode("ascii")
+    s256_b64 = base64.b64encode(record[56:88]).decode("ascii")
+    return private_key_b64, public_key_b64, s256_b64
+
+
+def generate_records(nkeys, workers, batch_size, allow_slash):
+    # Yields batches of records as they are generated, in order
+    batches = [batch_size] * (nkeys // batch_size) + ([nkeys % batch_size] if nkeys % batch_size else [])
+    if workers <= 1:
+        for count in batches:
+            yield generate_batch(count, allow_slash)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(generate_batch, batches, [allow_slash] * len(batches))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--nkeys', help='number of keys to generate', type=int, default=1)
+    parser.add_argument('-p', '--prefix', help='prefix of the keyfiles')
+    parser.add_argument('-y', '--yaml', help='yaml file where to write the list of generated keys')
+    parser.add_argument('-v', '--verbose', help='print keys as they are generated', action="store_true")
+    parser.add_argument('-f', '--format', choices=['files', 'bulk'], default='files',
+                        help='one .keys file per key, or every key in a single bulk file (default: files)')
+    parser.add_argument('-o', '--output',
+                        help='bulk file to write, must not exist yet (default: keys/<prefix or "keys">.bin)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes generating keys (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='keys generated per worker task')
+    args = parser.parse_args()
+
+    if args.yaml:
+        yaml = open(args.yaml + '.yaml', 'w')
+        yaml.write('  keys:\n')
+
+    if not os.path.exists(KEYS_DIR):
+        os.makedirs(KEYS_DIR)
+
+    bulk = None
+    if args.format == 'bulk':
+        bulk_path = args.output or os.path.join(KEYS_DIR, '%s.bin' % (args.prefix or 'keys'))
+        try:
+            # Never truncate a bulk file, it holds the only copy of the private keys of tags already provisioned
+            bulk = open(bulk_path, 'xb')
+        except FileExistsError:
+            parser.error('%s already exists, choose another --prefix or --output' % bulk_path)
+        bulk.write(BULK_MAGIC)
+
+    start = time.monotonic()
+    i = 0
+    for records in generate_records(args.nkeys, args.workers, max(1, args.batch_size), args.format == 'bulk'):
+        if bulk:
+            bulk.write(records)
+        yaml_lines = []
+        for offset in range(0, len(records), RECORD_SIZE):
+            i += 1
+            if not (args.verbose or args.yaml or args.format == 'files'):
+                continue
+            private_key_b64, public_key_b64, s256_b64 = split_record(records[offset:offset + RECORD_SIZE])
 
-        if '/' in s256_b64[:7]:
-            pass
-        else:
             if args.verbose:
-                print('%d)' % (i + 1))
+                print('%d)' % i)
                 print('Private key: %s' % private_key_b64)
                 print('Advertisement key: %s' % public_key_b64)
                 print('Hashed adv key: %s' % s256_b64)
 
-            if args.prefix:
-                fname = '%s_%s.keys' % (args.prefix, s256_b64[:7])
-            else:
-                fname = '%s.keys' % s256_b64[:7]
-
-            #mkdir keys
+            if args.format == 'files':
+                if args.prefix:
+                    fname = '%s_%s.keys' % (args.prefix, s256_b64[:7])
+                else:
+                    fname = '%s.keys' % s256_b64[:7]
 
-            with open(f"keys/{fname}", 'w') as f:
-                f.write('Private key: %s\n' % private_key_b64)
-                f.write('Advertisement key: %s\n' % public_key_b64)
-                f.write('Hashed adv key: %s\n' % s256_b64)
+                with open(os.path.join(KEYS_DIR, fname), 'w') as f:
+                    f.write('Private key: %s\n' % private_key_b64)
+                    f.write('Advertisement key: %s\n' % public_key_b64)
+                    f.write('Hashed adv key: %s\n' % s256_b64)
 
             if args.yaml:
-                yaml.write('    - "%s"\n' % public_key_b64)
-        break
+                yaml_lines.append('    - "%s"\n' % public_key_b64)
+        if args.yaml:
+            yaml.writelines(yaml_lines)
+
+    if bulk:
+        bulk.close()
+    if args.yaml:
+        yaml.close()
+
+    elapsed = time.monotonic() - start
+    print('Generated %d keys in %.2fs (%.0f keys/s)' % (i, elapsed, i / elapsed if elapsed > 0 else 0))
+
+    # Keep an existing keystore in step with the key files
+    keystore_path = os.path.join(KEYS_DIR, 'keys.store')
+    if os.path.exists(keystore_path):
+        print('%d keys in %s' % (import_keys(KEYS_DIR, keystore_path), keystore_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import asyncio
+import base64
+import datetime
+import os
+import random
+import uuid
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+
+class FakeAnisetteServer:
+    """
+    Stand-in for anisette-v3-server, answers ``GET /`` with the same JSON fields. The machine id is fixed for the
+    life of the server and the one-time password is random on every request, nothing here is accepted by Apple.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._machine_id = base64.b64encode(os.urandom(60)).decode()
+        self._local_user = base64.b64encode(str(uuid.uuid4()).upper().encode()).decode()
+        self._device_id = str(uuid.uuid4()).upper()
+
+    def headers(self) -> {}:
+        return {
+            "X-Apple-I-Client-Time": datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+            "X-Apple-I-MD": base64.b64encode(os.urandom(24)).decode(),
+            "X-Apple-I-MD-LU": self._local_user,
+            "X-Apple-I-MD-M": self._machine_id,
+            "X-Apple-I-MD-RINFO": "17106176",
+            "X-Apple-I-SRL-NO": "0",
+            "X-Apple-I-TimeZone": "UTC",
+            "X-Apple-Locale": "en_US",
+            "X-MMe-Client-Info": "<MacBookPro13,2> <macOS;13.1;22C65> <com.apple.AuthKit/1 (com.apple.dt.Xcode/3594.4.19)>",
+            "X-Mme-Device-Id": self._device_id,
+        }
+
+    def stats(self) -> {}:
+        return {"requests": self.requests, "errors": self.errors}
+
+    def create_app(self) -> FastAPI:
+        app = FastAPI(title="Fake anisette server")
+
+        @app.get("/")
+        async def anisette():
+            self.requests += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return JSONResponse(content={"error": "provisioning failed"}, status_code=500)
+            return self.headers()
+
+        return app
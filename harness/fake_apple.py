@@ -0,0 +1,119 @@
+import asyncio
+import base64
+import glob
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from benchmarks.finder import APPLE_EPOCH, FinderDevice, random_location
+from cores.key_map import derive_key_pair
+from cores.keystore import read_bulk_file, read_keys_file
+
+
+def load_advertisement_keys(directory: str) -> {}:
+    # hashed adv key -> advertisement key, from the .keys and bulk .bin files generate_keys.py writes
+    keys = {}
+    for keyfile in glob.glob(os.path.join(directory, '*.keys')):
+        found = read_keys_file(keyfile)
+        if found is None:
+            continue
+        hashed, private, public = found
+        keys[hashed] = public or derive_key_pair(private)[1]
+    for bulkfile in glob.glob(os.path.join(directory, '*.bin')):
+        for hashed, _, public, _ in read_bulk_file(bulkfile):
+            keys[hashed] = public
+    return keys
+
+
+class FakeFetchServer:
+    """
+    Stand-in for Apple's acsnservice/fetch endpoint.
+
+    Ids whose advertisement key is known get ``reports_per_id`` reports that decrypt with the matching private
+    key, other ids get none. The reports of an id are encrypted once and re-stamped inside the requested window
+    on every request, so the server can answer at volume without spending its time on ECDH. Every request waits
+    ``latency`` plus up to ``jitter`` seconds, and fails with ``error_status`` at ``error_rate``.
+    """
+
+    def __init__(self, advertisement_keys: {}, reports_per_id: int = 10, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 500):
+        self.advertisement_keys = advertisement_keys
+        self.reports_per_id = reports_per_id
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self.unauthorized = 0
+        self.ids_requested = 0
+        self.reports_served = 0
+        self._payloads = {}
+
+    def _encrypted_reports(self, hashed_adv_key: str) -> [bytes]:
+        payloads = self._payloads.get(hashed_adv_key)
+        if payloads is None:
+            finder = FinderDevice(self.advertisement_keys[hashed_adv_key])
+            payloads = []
+            for _ in range(self.reports_per_id):
+                lat, lon = random_location()
+                payloads.append(base64.b64decode(finder.report(lat=lat, lon=lon, confidence=random.randint(1, 3))))
+            self._payloads[hashed_adv_key] = payloads
+        return payloads
+
+    def results(self, ids: [str], start_date: int, end_date: int) -> [{}]:
+        # Timestamps are spread over the window, the first 4 bytes of a payload are not covered by AES-GCM
+        end_date = min(end_date, int(time.time() * 1000))
+        results = []
+        for hashed_adv_key in ids:
+            if hashed_adv_key not in self.advertisement_keys:
+                continue
+            payloads = self._encrypted_reports(hashed_adv_key)
+            step = max(0, end_date - start_date) // len(payloads) if payloads else 0
+            for index, payload in enumerate(payloads):
+                date_published = start_date + step * index + random.randint(0, max(0, step - 1))
+                timestamp = max(0, date_published // 1000 - APPLE_EPOCH - random.randint(0, 300))
+                payload = timestamp.to_bytes(4, byteorder='big') + payload[4:]
+                results.append({"datePublished": date_published, "payload": base64.b64encode(payload).decode(),
+                                "description": "found", "id": hashed_adv_key, "statusCode": 0})
+        return results
+
+    def stats(self) -> {}:
+        return {"requests": self.requests, "errors": self.errors, "unauthorized": self.unauthorized,
+                "ids_requested": self.ids_requested, "reports_served": self.reports_served,
+                "ids_encrypted": len(self._payloads)}
+
+    def create_app(self) -> FastAPI:
+        app = FastAPI(title="Fake acsnservice")
+
+        @app.post("/acsnservice/fetch")
+        async def fetch(request: Request):
+            self.requests += 1
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+            if "authorization" not in request.headers:
+                self.unauthorized += 1
+                return JSONResponse(content={"statusCode": "401"}, status_code=401)
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return JSONResponse(content={"statusCode": str(self.error_status)}, status_code=self.error_status)
+
+            body = await request.json()
+            results = []
+            for search in body.get("search", []):
+                ids = search.get("ids", [])
+                self.ids_requested += len(ids)
+                # Encrypting the first reports of many new ids takes a while, keep the event loop free meanwhile
+                results += await asyncio.to_thread(self.results, ids, int(search.get("startDate", 0)),
+                                                   int(search.get("endDate", 0)))
+            self.reports_served += len(results)
+            return {"statusCode": "200", "results": results}
+
+        @app.get("/harness/stats")
+        async def stats():
+            return self.stats()
+
+        return app
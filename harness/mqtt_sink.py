@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+import struct
+import time
+from collections import deque
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK = range(1, 10)
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def _read_string(data: bytes, offset: int) -> (bytes, int):
+    length = struct.unpack_from('>H', data, offset)[0]
+    return data[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+async def _read_packet(reader: asyncio.StreamReader) -> (int, int, bytes):
+    first = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return first >> 4, first & 0x0f, await reader.readexactly(length)
+
+
+class MqttSink:
+    """
+    Minimal MQTT 3.1.1 broker that accepts every connection and records what is published to it.
+
+    PUBLISH is acknowledged for QoS 1 and 2, subscriptions are refused and nothing is forwarded. The last
+    ``history`` deliveries are kept in memory, all of them are appended to ``record_path`` as JSON lines when set.
+    """
+
+    def __init__(self, history: int = 10000, record_path: str = None):
+        self.deliveries = deque(maxlen=history)
+        self.record_path = record_path
+        self.connections = 0
+        self.published = 0
+        self.topics = set()
+        self._record = None
+
+    def _deliver(self, client_id: str, username: str, topic: str, payload: bytes, qos: int, retain: bool):
+        delivery = {"time": time.time(), "client_id": client_id, "username": username, "topic": topic,
+                    "payload": payload.decode('utf-8', errors='replace'), "qos": qos, "retain": retain}
+        self.deliveries.append(delivery)
+        self.published += 1
+        self.topics.add(topic)
+        if self.record_path:
+            if self._record is None:
+                self._record = open(self.record_path, 'a')
+            self._record.write(json.dumps(delivery) + '\n')
+            self._record.flush()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_id = username = ''
+        try:
+            while True:
+                packet_type, flags, data = await _read_packet(reader)
+                if packet_type == CONNECT:
+                    _, offset = _read_string(data, 0)
+                    connect_flags = data[offset + 1]
+                    raw_client_id, offset = _read_string(data, offset + 4)
+                    client_id = raw_client_id.decode()
+                    if connect_flags & 0x04:
+                        _, offset = _read_string(data, offset)
+                        _, offset = _read_string(data, offset)
+                    if connect_flags & 0x80:
+                        username = _read_string(data, offset)[0].decode()
+                    self.connections += 1
+                    writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 3
+                    topic, offset = _read_string(data, 0)
+                    if qos:
+                        packet_id = data[offset:offset + 2]
+                        offset += 2
+                        writer.write(bytes([(PUBACK if qos == 1 else PUBREC) << 4, 2]) + packet_id)
+                    self._deliver(client_id, username, topic.decode(), data[offset:], qos, bool(flags & 1))
+                elif packet_type == PUBREL:
+                    writer.write(bytes([PUBCOMP << 4, 2]) + data[:2])
+                elif packet_type == SUBSCRIBE:
+                    topics, offset = 0, 2
+                    while offset < len(data):
+                        _, offset = _read_string(data, offset)
+                        offset += 1
+                        topics += 1
+                    writer.write(bytes([SUBACK << 4, 2 + topics]) + data[:2] + b'\x80' * topics)
+                elif packet_type == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.warning(f"MQTT sink dropped {client_id or 'a client'}: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 1883):
+        server = await asyncio.start_server(self._handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def stats(self) -> {}:
+        return {"connections": self.connections, "published": self.published, "topics": len(self.topics)}
+
+    def close(self):
+        if self._record is not None:
+            self._record.close()
+            self._record = None
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for Apple's fetch endpoint, the anisette server and the MQTT brokers, for load testing without
+touching Apple. Run from the repository root:
+
+    python3 -m harness.run --reports-per-id 20 --latency 0.2 --error-rate 0.01
+
+then point the service at it:
+
+    python3 web_service.py --fetch-url http://127.0.0.1:8081/acsnservice/fetch --anisette-url http://127.0.0.1:6969
+
+and give the tags mqtt_server 127.0.0.1, port 1883 and TLS off to have the sink record their publishes.
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+import uvicorn
+
+from harness.fake_anisette import FakeAnisetteServer
+from harness.fake_apple import FakeFetchServer, load_advertisement_keys
+from harness.mqtt_sink import MqttSink
+
+
+async def report_stats(fetch: FakeFetchServer, anisette: FakeAnisetteServer, sink: MqttSink, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(json.dumps({"fetch": fetch.stats(), "anisette": anisette.stats(), "mqtt": sink.stats()}))
+
+
+async def serve(args):
+    keys = load_advertisement_keys(args.keys)
+    logging.info(f"Serving reports for {len(keys)} keys from {args.keys}")
+    fetch = FakeFetchServer(keys, reports_per_id=args.reports_per_id, latency=args.latency, jitter=args.jitter,
+                            error_rate=args.error_rate, error_status=args.error_status)
+    anisette = FakeAnisetteServer(latency=args.anisette_latency, error_rate=args.anisette_error_rate)
+    sink = MqttSink(record_path=args.record)
+    servers = [uvicorn.Server(uvicorn.Config(fetch.create_app(), host=args.host, port=args.fetch_port,
+                                             log_level="warning")),
+               uvicorn.Server(uvicorn.Config(anisette.create_app(), host=args.host, port=args.anisette_port,
+                                             log_level="warning"))]
+    logging.info(f"Fetch on http://{args.host}:{args.fetch_port}/acsnservice/fetch, anisette on "
+                 f"http://{args.host}:{args.anisette_port}, MQTT sink on {args.host}:{args.mqtt_port}")
+    tasks = [asyncio.create_task(sink.serve(args.host, args.mqtt_port))]
+    if args.stats_interval > 0:
+        tasks.append(asyncio.create_task(report_stats(fetch, anisette, sink, args.stats_interval)))
+    try:
+        # Only the last uvicorn server started receives Ctrl+C, the other one is stopped once it exited
+        serving = [asyncio.create_task(server.serve()) for server in servers]
+        await asyncio.wait(serving, return_when=asyncio.FIRST_COMPLETED)
+        for server in servers:
+            server.should_exit = True
+        await asyncio.gather(*serving)
+    finally:
+        for task in tasks:
+            task.cancel()
+        sink.close()
+        logging.info(json.dumps({"fetch": fetch.stats(), "anisette": anisette.stats(), "mqtt": sink.stats()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-ins for Apple, anisette and MQTT")
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--fetch-port', type=int, default=8081, help='fake fetch endpoint port (default: 8081)')
+    parser.add_argument('--anisette-port', type=int, default=6969, help='fake anisette server port (default: 6969)')
+    parser.add_argument('--mqtt-port', type=int, default=1883, help='MQTT sink port (default: 1883)')
+    parser.add_argument('-k', '--keys', default='keys',
+                        help='directory with the .keys and bulk files to serve reports for (default: keys)')
+    parser.add_argument('-n', '--reports-per-id', type=int, default=10,
+                        help='reports returned per known id and request (default: 10)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fetch (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many random seconds added on top of --latency (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fetches that fail (default: 0)')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP status of failed fetches (default: 500)')
+    parser.add_argument('--anisette-latency', type=float, default=0.0,
+                        help='seconds added to every anisette request (default: 0)')
+    parser.add_argument('--anisette-error-rate', type=float, default=0.0,
+                        help='fraction of anisette requests that fail (default: 0)')
+    parser.add_argument('--record', help='append every MQTT delivery to this file as JSON lines')
+    parser.add_argument('--stats-interval', type=float, default=10.0,
+                        help='seconds between stats log lines, 0 disables (default: 10)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,40 @@
 #!/usr/bin/env python3
 import argparse
-import base64
+import asyncio
 import datetime
-import glob
-import hashlib
 import json
 import os
-import sqlite3
-import struct
-
-import requests
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import time
 
 from cores.pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers
-
-
-def sha256(data):
-    digest = hashlib.new("sha256")
-    digest.update(data)
-    return digest.digest()
-
-
-def decrypt(enc_data, algorithm_dkey, mode):
-    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
-    return decryptor.update(enc_data) + decryptor.finalize()
-
-
-def decode_tag(data):
-    latitude = struct.unpack(">i", data[0:4])[0] / 10000000.0
-    longitude = struct.unpack(">i", data[4:8])[0] / 10000000.0
-    confidence = int.from_bytes(data[8:9])
-    status = int.from_bytes(data[9:10])
-    return {'lat': latitude, 'lon': longitude, 'conf': confidence, 'status': status}
+from cores.report_decoder import decrypt_reports
+from cores.upstream import UpstreamClient
+from cores.token_pool import TokenPool, load_accounts, read_auth, save_auth
+from cores.storage import ReportStore
+from cores.report_triage import triage_reports, triage_counts, KEEP
+from cores.keystore import KeyStore, import_keys, keystore_outdated
+from cores.metrics import PROMETHEUS_AVAILABLE, STAGE_SECONDS, REPORTS_FETCHED, REPORTS_DECRYPTED, REPORTS_FAILED, \
+    stage_timer, write_textfile
 
 
 def getAuth(regenerate=False, second_factor='sms'):
+    # Every account of keys/auth.json. Regenerating logs in again and replaces the token of that account, other
+    # accounts added with web_service.py --add-account are kept
     CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + "/keys/auth.json"
-    if os.path.exists(CONFIG_PATH) and not regenerate:
-        with open(CONFIG_PATH, "r") as f:
-            j = json.load(f)
-    else:
+    entries = read_auth(CONFIG_PATH) if os.path.exists(CONFIG_PATH) else []
+    if not entries or regenerate:
         mobileme = icloud_login_mobileme(second_factor=second_factor)
-        j = {'dsid': mobileme['dsid'],
-             'searchPartyToken': mobileme['delegates']['com.apple.mobileme']['service-data']['tokens'][
-                 'searchPartyToken']}
-        with open(CONFIG_PATH, "w") as f:
-            json.dump(j, f)
-    return (j['dsid'], j['searchPartyToken'])
+        save_auth(CONFIG_PATH, mobileme['dsid'],
+                  mobileme['delegates']['com.apple.mobileme']['service-data']['tokens']['searchPartyToken'])
+    return load_accounts(CONFIG_PATH)
+
+
+async def fetch_reports(ids, start_date, end_date, accounts):
+    upstream = UpstreamClient(pool=TokenPool(accounts))
+    try:
+        return await upstream.fetch_reports(ids, start_date, end_date, headers=generate_anisette_headers())
+    finally:
+        await upstream.close()
 
 
 if __name__ == "__main__":
@@ -60,83 +46,90 @@ if __name__ == "__main__":
         parser.add_argument('-r', '--regen', help='regenerate search-party-token', action='store_true')
         parser.add_argument('-t', '--trusteddevice', help='use trusted device for 2FA instead of SMS',
                             action='store_true')
+        parser.add_argument('-k', '--keystore', help='keystore to read keys from (default: keys/keys.store), '
+                                                     'only rebuilt from keys/ with --reindex')
+        parser.add_argument('--reindex', help='rebuild the keystore from the .keys and bulk files in keys/, '
+                                              'the default keystore is otherwise rebuilt once any of them changed',
+                            action='store_true')
+        parser.add_argument('--metrics-file', help='write stage timings and report counters to this file in the '
+                                                   'Prometheus text format, e.g. for node_exporter')
         args = parser.parse_args()
 
-        sq3db = sqlite3.connect(os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db')
-        sq3 = sq3db.cursor()
+        store = ReportStore(os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db')
+
+        keys_dir = os.path.dirname(os.path.realpath(__file__)) + '/keys'
+        keystore_path = args.keystore or keys_dir + '/keys.store'
+        # A keystore given with -k may hold keys that are not in keys/, it is never overwritten unasked
+        if args.reindex or (not args.keystore and keystore_outdated(keys_dir, keystore_path)):
+            # read key files generated with generate_keys.py into the keystore whenever one was added or changed
+            print(f'{import_keys(keys_dir, keystore_path)} keys imported into {keystore_path}.')
+        elif not os.path.exists(keystore_path):
+            raise FileNotFoundError(f'Keystore {keystore_path} not found, pass --reindex to build it from {keys_dir}')
 
         privkeys = {}
         names = {}
-        for keyfile in glob.glob(os.path.dirname(os.path.realpath(__file__)) + '/keys/' + args.prefix + '*.keys'):
-            # read key files generated with generate_keys.py
-            with open(keyfile) as f:
-                hashed_adv = priv = ''
-                name = os.path.basename(keyfile)[len(args.prefix):-5]
-                for line in f:
-                    key = line.rstrip('\n').split(': ')
-                    if key[0] == 'Private key':
-                        priv = key[1]
-                    elif key[0] == 'Hashed adv key':
-                        hashed_adv = key[1]
-
-                if priv and hashed_adv:
-                    privkeys[hashed_adv] = priv
-                    names[hashed_adv] = name
-                else:
-                    print(f"Couldn't find key pair in {keyfile}")
+        keystore = KeyStore(keystore_path)
+        for hashed_adv, priv, _, name in keystore.by_name_prefix(args.prefix):
+            privkeys[hashed_adv] = priv
+            names[hashed_adv] = name[len(args.prefix):]
+        keystore.close()
 
         unixEpoch = int(datetime.datetime.now().timestamp())
         startdate = unixEpoch - (60 * 60 * args.hours)
-        data = {"search": [{"startDate": startdate * 1000, "endDate": unixEpoch * 1000, "ids": list(names.keys())}]}
 
-        r = requests.post("https://gateway.icloud.com/acsnservice/fetch",
-                          auth=getAuth(regenerate=args.regen,
-                                       second_factor='trusted_device' if args.trusteddevice else 'sms'),
-                          headers=generate_anisette_headers(),
-                          json=data)
-        res = json.loads(r.content.decode())['results']
-        print(f'{r.status_code}: {len(res)} reports received.')
+        response = asyncio.run(fetch_reports(list(names.keys()), startdate * 1000, unixEpoch * 1000, accounts=getAuth(
+            regenerate=args.regen, second_factor='trusted_device' if args.trusteddevice else 'sms')))
+        res = response['results']
+        print(f'{len(res)} reports received.')
+        REPORTS_FETCHED.inc(len(res))
+        for failure in response.get('failedChunks', []):
+            print(f"{len(failure['ids'])} keys could not be fetched: {failure['error']}")
+
+        # Drop malformed, out of window and repeated reports before spending any ECDH on them
+        triage = triage_reports([report['payload'] for report in res], ids=[report['id'] for report in res],
+                                start=startdate)
+        counts = triage_counts(triage)
+        REPORTS_FAILED.labels('malformed').inc(counts['malformed'])
+        print(f"{counts['malformed']} malformed, {counts['out_of_window']} out of window and "
+              f"{counts['duplicate']} duplicate reports skipped.")
 
         ordered = []
         found = set()
-
-        # SQL query to create a table named 'report' if it does not exist
-        create_table_query = '''CREATE TABLE IF NOT EXISTS reports (
-        id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT, 
-        id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER, PRIMARY KEY(id_short,timestamp));'''
-
-        # Execute the SQL query
-        sq3.execute(create_table_query)
-
-        for report in res:
-            priv = int.from_bytes(base64.b64decode(privkeys[report['id']]), byteorder='big')
-            data = base64.b64decode(report['payload'])
-            # the following is all copied from https://github.com/hatomist/openhaystack-python, thanks @hatomist!
-            timestamp = int.from_bytes(data[0:4], 'big') + 978307200
-
-            if timestamp >= startdate:
-                eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[5:62])
-                shared_key = ec.derive_private_key(priv, ec.SECP224R1(), default_backend()).exchange(ec.ECDH(), eph_key)
-                symmetric_key = sha256(shared_key + b'\x00\x00\x00\x01' + data[5:62])
-                decryption_key = symmetric_key[:16]
-                iv = symmetric_key[16:]
-                enc_data = data[62:72]
-                auth_tag = data[72:]
-
-                decrypted = decrypt(enc_data, algorithms.AES(decryption_key), modes.GCM(iv, auth_tag))
-                tag = decode_tag(decrypted)
-                tag['timestamp'] = timestamp
-                tag['isodatetime'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
-                tag['key'] = names[report['id']]
+        rows = []
+
+        # The kept reports of each key are decrypted as one batch, deriving the private key once
+        kept = {}
+        for report, status in zip(res, triage['status']):
+            if status == KEEP:
+                kept.setdefault(report['id'], []).append(report)
+
+        started = time.perf_counter()
+        failed = 0
+        for hashed_adv, reports in kept.items():
+            results = decrypt_reports([report['payload'] for report in reports], privkeys[hashed_adv])
+            for report, result in zip(reports, results):
+                if not result['decrypt_success']:
+                    failed += 1
+                    continue
+                # conf is the horizontal accuracy byte of the location, not the confidence byte of the report
+                tag = {'lat': result['lat'], 'lon': result['lon'], 'conf': result['horizontal_accuracy'],
+                       'status': result['status'], 'timestamp': result['timestamp'],
+                       'isodatetime': result['isodatetime'], 'key': names[hashed_adv]}
                 tag['goog'] = 'https://maps.google.com/maps?q=' + str(tag['lat']) + ',' + str(tag['lon'])
                 found.add(tag['key'])
                 ordered.append(tag)
 
-                # SQL Injection Mitigation
-                query = "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                parameters = (names[report['id']], timestamp, report['datePublished'], report['payload'], report['id'],
-                              report['statusCode'], str(tag['lat']), str(tag['lon']), tag['conf'])
-                sq3.execute(query, parameters)
+                rows.append((names[hashed_adv], tag['timestamp'], report['datePublished'], report['payload'],
+                             report['id'], report['statusCode'], tag['lat'], tag['lon'], tag['conf']))
+
+        STAGE_SECONDS.labels('decrypt').observe(time.perf_counter() - started)
+        REPORTS_DECRYPTED.inc(len(ordered))
+        REPORTS_FAILED.labels('decrypt').inc(failed)
+        if failed:
+            print(f'{failed} reports could not be decrypted.')
+
+        with stage_timer('sqlite'):
+            store.insert_reports(rows, replace=True)
 
         print(f'{len(ordered)} reports used.')
         ordered.sort(key=lambda item: item.get('timestamp'))
@@ -144,9 +137,13 @@ if __name__ == "__main__":
         print(f'found:   {list(found)}')
         print(f'missing: {[key for key in names.values() if key not in found]}')
 
-        sq3.close()
-        sq3db.commit()
-        sq3db.close()
+        store.close()
+
+        if args.metrics_file:
+            if PROMETHEUS_AVAILABLE:
+                write_textfile(args.metrics_file)
+            else:
+                print('--metrics-file needs prometheus_client, install it with pip install prometheus_client')
 
     except Exception as e:
         if e == "AuthenticationError":
@@ -14,98 +14,229 @@
 #  * along with this program. If not, see <http://www.gnu.org/licenses/>.
 #  */
 #
+import asyncio
 import datetime
-import hashlib
 import json
 import os
 import re
-import sqlite3
-import struct
+import shlex
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
 from typing import Annotated
 
-import simplekml
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from fastapi import FastAPI, UploadFile, Header, Body
+from fastapi import APIRouter, FastAPI, UploadFile, Header, Body
 
-import requests
 from fastapi.params import Query, File, Form
-from fastapi.responses import JSONResponse, Response
-from pytz import timezone
-
-from request_reports import getAuth
-from cores.pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers
-from cryptography.hazmat.primitives.asymmetric import ec
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import pytz
+
+from cores.pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers, get_anisette_provider, \
+    set_anisette_url, ANISETTE_URL
+from cores.decryptor import BatchDecryptor
+from cores.key_map import KeyMap
+from cores.decrypt_cache import DecryptCache
+from cores.upstream import UpstreamClient, UpstreamError, FETCH_URL
+from cores.token_pool import TokenPool, STRATEGIES, load_accounts, read_auth, save_auth
+from cores.fetch_cache import FetchCache
+from cores.report_stream import ReportStreamParser
+from cores.storage import ReportStore
+from cores.mqtt_publisher import MqttPublisher
+from cores.scheduler import SyncScheduler
+from cores.report_triage import triage_reports, KEEP, MALFORMED
+from cores.keystore import WatchedKeyStore
+from cores.geo_writer import KmlWriter, GeoJsonWriter
+from cores.report_export import EXPORT_WRITERS, PARQUET_AVAILABLE
+from cores.metrics import PROMETHEUS_AVAILABLE, REPORTS_FETCHED, REPORTS_DECRYPTED, REPORTS_FAILED, MQTT_PUBLISHES, \
+    STAGE_SECONDS, stage_timer, register_cache, render as render_metrics
 
 import base64
 import logging
 import uvicorn
-import time
-import paho.mqtt.publish as publish
 import certifi
 import argparse
 
 logging.basicConfig(level=logging.INFO,)
 
-app = FastAPI(
-    title="FindMy Gateway API",
-    summary="Query Apple's Find My network, allowing none Apple devices to retrieve the location reports.",
-    description="### Important Concepts:  "
-                "\n**Private Key:** Use for decrypting the report.  "
-                "\n**Public Key / Advertisement Key:** Derive from the private key, used for broadcasting.  "
-                "\n**Hashed Advertisement Key:** SHA256 hashed public key, used for querying reports.  "
-)
-app.last_publish_time = 0
-
 CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + "/keys/auth.json"
 
-# Parse command line arguments
+# main() hands its command line to the uvicorn workers, which import this module afresh, in this variable
+ARGS_ENV = "FINDMY_WEB_SERVICE_ARGS"
+
+# Held in reports.db by the one process that runs the scheduled syncs
+SCHEDULER_LEASE = "scheduler"
+
+# Command line arguments, parsed by main() and again in every worker by create_app()
 parser = argparse.ArgumentParser(description='FindMy Gateway API Server')
 parser.add_argument('--auth', type=str, choices=['sms', 'trusted_device'], default='sms',
                     help='Authentication method to use: sms or trusted_device (default: sms)')
-args = parser.parse_args()
-
-if os.path.exists(CONFIG_PATH):
-    with open(CONFIG_PATH, "r") as f:
-        j = json.load(f)
-else:
-    # Create keys directory if it doesn't exist
-    keys_dir = os.path.dirname(CONFIG_PATH)
+parser.add_argument('--add-account', action='store_true',
+                    help='Log in with another Apple account and add it to keys/auth.json, requests to Apple are '
+                         'spread over all its accounts')
+parser.add_argument('--account-strategy', type=str, choices=STRATEGIES, default='least_loaded',
+                    help='How requests are spread over the accounts: least_loaded or round_robin '
+                         '(default: least_loaded)')
+parser.add_argument('--account-eject-seconds', type=float, default=60.0,
+                    help='Seconds an account that is throttled, rejected or failing is left out, doubling while it '
+                         'keeps failing (default: 60)')
+parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Server processes, they share the fetch cache and scheduler through reports.db (default: 1)')
+parser.add_argument('--decrypt-workers', type=int, default=None,
+                    help='Processes used to decrypt reports, 0 decrypts in the server process '
+                         '(default: CPU count divided by --workers)')
+parser.add_argument('--upstream-timeout', type=float, default=30.0,
+                    help='Seconds to wait for each request to Apple (default: 30)')
+parser.add_argument('--upstream-concurrency', type=int, default=8,
+                    help='Maximum requests to Apple in flight at a time (default: 8)')
+parser.add_argument('--upstream-chunk-size', type=int, default=256,
+                    help='Maximum keys per request to Apple, larger key sets are split (default: 256)')
+parser.add_argument('--fetch-cache-ttl', type=float, default=30.0,
+                    help='Seconds to reuse encrypted report responses for identical queries, 0 disables (default: 30)')
+parser.add_argument('--fetch-cache-size', type=int, default=1024,
+                    help='Maximum cached encrypted report responses (default: 1024)')
+parser.add_argument('--decrypt-cache-size', type=int, default=65536,
+                    help='Decrypted payloads kept in memory so repeated payloads skip ECDH and AES-GCM, 0 disables '
+                         '(default: 65536)')
+parser.add_argument('--persist-decrypt-cache', action='store_true',
+                    help='Also keep decrypted payloads in reports.db, including those of uploaded reports')
+parser.add_argument('--keystore-fallback', action='store_true',
+                    help='Decrypt uploaded reports no private key was given for with the keys in keys/keys.store. '
+                         'Anyone who knows a hashed advertisement key can then read its locations')
+parser.add_argument('--timezone', type=str, default='America/New_York',
+                    help='Default time zone of MultiDecryptToKML placemarks (default: America/New_York)')
+parser.add_argument('--sync-min-interval', type=float, default=60.0,
+                    help='Shortest seconds between syncs of one tag, busy tags approach this (default: 60)')
+parser.add_argument('--sync-max-interval', type=float, default=3600.0,
+                    help='Longest seconds between syncs of one tag, dormant tags approach this (default: 3600)')
+parser.add_argument('--disable-scheduler', action='store_true',
+                    help='Only sync and publish when /Publish_MQTT/ is called')
+parser.add_argument('--fetch-url', type=str, default=FETCH_URL,
+                    help=f'Report fetch endpoint, e.g. a local stand-in from harness/ (default: {FETCH_URL})')
+parser.add_argument('--anisette-url', type=str, default=ANISETTE_URL,
+                    help=f'Anisette server used when pyprovision is not installed (default: {ANISETTE_URL})')
+
+# Set by create_app() and the lifespan, every worker process has its own
+args = None
+token_pool = None
+decryptor = upstream = fetch_cache = store = key_map = decrypt_cache = keystore = mqtt_publisher = scheduler = None
+worker_id = None
+
+router = APIRouter()
+
+
+def load_auth(second_factor: str = 'sms', add_account: bool = False) -> list:
+    # Accounts of keys/auth.json, logging in to create it on first start or to add another account
+    entries = read_auth(CONFIG_PATH) if os.path.exists(CONFIG_PATH) else []
+    if not entries or add_account:
+        # Create keys directory if it doesn't exist
+        keys_dir = os.path.dirname(CONFIG_PATH)
+        os.makedirs(keys_dir, exist_ok=True)
+
+        # Logging in again with an account already in auth.json renews its token instead of adding it twice
+        mobileme = icloud_login_mobileme(second_factor=second_factor)
+        save_auth(CONFIG_PATH, mobileme['dsid'],
+                  mobileme['delegates']['com.apple.mobileme']['service-data']['tokens']['searchPartyToken'])
+    return load_accounts(CONFIG_PATH)
+
+
+def startup():
+    # Opens everything a worker serves requests with. Runs in the lifespan, so every worker process has its own
+    # connections and pools, state the workers share lives in reports.db.
+    global token_pool, decryptor, upstream, fetch_cache, store, key_map, decrypt_cache, keystore, \
+        mqtt_publisher, scheduler, worker_id
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    token_pool = TokenPool(load_auth(args.auth), strategy=args.account_strategy,
+                           eject_seconds=args.account_eject_seconds)
+    logging.info(f"Fetching with {len(token_pool)} search party account(s)")
+
+    decrypt_workers = args.decrypt_workers
+    if decrypt_workers is None and args.workers > 1:
+        # The server processes already occupy the cores, 0 decrypts in the server process itself
+        decrypt_workers = (os.cpu_count() or 1) // args.workers
+    decryptor = BatchDecryptor(max_workers=decrypt_workers)
+    upstream = UpstreamClient(url=args.fetch_url, timeout=args.upstream_timeout,
+                              max_concurrency=args.upstream_concurrency, chunk_size=args.upstream_chunk_size,
+                              pool=token_pool)
+
+    # Ensure keys directory exists before creating database
+    keys_dir = os.path.dirname(os.path.realpath(__file__)) + '/keys'
     os.makedirs(keys_dir, exist_ok=True)
-    
-    mobileme = icloud_login_mobileme(second_factor=args.auth)
-    j = {'dsid': mobileme['dsid'],
-         'searchPartyToken': mobileme['delegates']['com.apple.mobileme']['service-data']['tokens'][
-             'searchPartyToken']}
-    with open(CONFIG_PATH, "w") as f:
-        json.dump(j, f)
-
-dsid = j['dsid']
-searchPartyToken = j['searchPartyToken']
-
-# Ensure keys directory exists before creating database
-keys_dir = os.path.dirname(os.path.realpath(__file__)) + '/keys'
-os.makedirs(keys_dir, exist_ok=True)
-
-sq3db = sqlite3.connect(os.path.dirname(os.path.realpath(__file__)) + '/keys/reports.db')
-_sq3 = sq3db.cursor()
-
-# SQL query to create a table named 'report' if it does not exist
-create_table_query = '''CREATE TABLE IF NOT EXISTS tags (
-        hash_adv_key TEXT, private_key TEXT, friendly_name TEXT, mqtt_server TEXT, mqtt_port INTEGER, mqtt_over_tls BOOLEAN,
-        mqtt_publish_encryption_key TEXT, mqtt_username TEXT, mqtt_userpass TEXT, mqtt_topic TEXT,
-        PRIMARY KEY(private_key,mqtt_server));'''
-
-# Execute the SQL query
-_sq3.execute(create_table_query)
-
-# SQL query to create a table named 'report' if it does not exist
-create_table_query = '''CREATE TABLE IF NOT EXISTS reports (
-id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT, 
-id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER, PRIMARY KEY(id,payload));'''
 
-# Execute the SQL query
-_sq3.execute(create_table_query)
+    store = ReportStore(keys_dir + '/reports.db')
+
+    # Only complete, successful responses are reused, with several workers through reports.db
+    fetch_cache = FetchCache(
+        ttl=args.fetch_cache_ttl, maxsize=args.fetch_cache_size, store=store if args.workers > 1 else None,
+        cacheable=lambda reports: reports.get("statusCode") == "200" and "failedChunks" not in reports)
+
+    key_map = KeyMap(store)
+
+    decrypt_cache = DecryptCache(store if args.persist_decrypt_cache else None, maxsize=args.decrypt_cache_size)
+
+    # Keys of keys/keys.store, used for uploaded reports no private key was given for only when asked to
+    keystore = WatchedKeyStore(keys_dir + '/keys.store') if args.keystore_fallback else None
+
+    # Brokers drop the older of two connections sharing a client id, every worker connects as its own
+    mqtt_publisher = MqttPublisher(ca_certs=certifi.where(),
+                                   client_id_suffix=f"-{os.getpid()}" if args.workers > 1 else "")
+
+    # Whichever process holds the lease syncs on schedule, it passes on when the holder stops renewing it
+    scheduler = SyncScheduler(scheduled_sync, lambda: store.tag_private_keys().keys(), publish=publish_latest_locations,
+                              min_interval=args.sync_min_interval, max_interval=args.sync_max_interval,
+                              leader=lambda: store.acquire_lease(SCHEDULER_LEASE, worker_id,
+                                                                 3 * args.sync_min_interval),
+                              synced_at=lambda: {hash_key: synced_until / 1000 for hash_key, synced_until
+                                                 in store.synced_until().items() if synced_until})
+
+    register_cache("fetch", fetch_cache.stats)
+    register_cache("key_map", key_map.stats)
+    register_cache("decrypt", decrypt_cache.stats)
+    register_cache("anisette", lambda: get_anisette_provider().stats())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup()
+    get_anisette_provider().start_prefetch()
+    if not args.disable_scheduler:
+        scheduler.start()
+    yield
+    await scheduler.stop()
+    store.release_lease(SCHEDULER_LEASE, worker_id)
+    get_anisette_provider().stop_prefetch()
+    await upstream.close()
+    decryptor.shutdown()
+    mqtt_publisher.close()
+    if keystore is not None:
+        keystore.close()
+    store.close()
+
+
+def create_app(argv: list = None) -> FastAPI:
+    """
+    App factory, ``uvicorn web_service:create_app --factory``. Options are parsed from ``argv``, or from the
+    FINDMY_WEB_SERVICE_ARGS environment variable, nothing is opened before the lifespan starts.
+    """
+    global args
+    args = parser.parse_args(shlex.split(os.environ.get(ARGS_ENV, "")) if argv is None else argv)
+    set_anisette_url(args.anisette_url)
+
+    app = FastAPI(
+        lifespan=lifespan,
+        title="FindMy Gateway API",
+        summary="Query Apple's Find My network, allowing none Apple devices to retrieve the location reports.",
+        description="### Important Concepts:  "
+                    "\n**Private Key:** Use for decrypting the report.  "
+                    "\n**Public Key / Advertisement Key:** Derive from the private key, used for broadcasting.  "
+                    "\n**Hashed Advertisement Key:** SHA256 hashed public key, used for querying reports.  "
+    )
+    app.include_router(router)
+    return app
 
 
 def private_key_from_json(private_keys: str) -> set():
@@ -125,74 +256,172 @@ def private_key_from_json(private_keys: str) -> set():
 
 def private_to_hashed_key(private_key_b64: str) -> str:
     logging.debug(f"Private Key B64: {private_key_b64}")
-    private_key = ec.derive_private_key(int.from_bytes(base64.b64decode(private_key_b64), byteorder="big"),
-                                        ec.SECP224R1(), default_backend())
-
-    public_key = private_key.public_key()
-    public_key_bytes = public_key.public_numbers().x.to_bytes(28, byteorder='big')
-
-    logging.debug(f"Public Key Bytes: {public_key_bytes.hex()}")
-    digest = hashlib.new("sha256")
-    digest.update(public_key_bytes)
-    sha_value = digest.digest()
-    s256_b64 = base64.b64encode(sha_value).decode("ascii")
+    s256_b64 = key_map.lookup(private_key_b64)[0]
     logging.debug(f"Hash ADV Key: {s256_b64}")
     return s256_b64
 
 
-def sha256(data):
-    digest = hashlib.new("sha256")
-    digest.update(data)
-    return digest.digest()
-
-
-def decrypt(enc_data, algorithm_dkey, mode):
-    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
-    return decryptor.update(enc_data) + decryptor.finalize()
-
-
-def decrypt_payload(report: str, private_key: str) -> {}:
-    data = base64.b64decode(report)
-    priv = int.from_bytes(base64.b64decode(private_key), byteorder="big")
-
-    timestamp = int.from_bytes(data[0:4], byteorder="big") + 978307200
-    if len(data) == 88:
-        confidence = int.from_bytes(data[4:5], byteorder="big")
-        eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[5:62])
-        shared_key = ec.derive_private_key(priv, ec.SECP224R1(), default_backend()).exchange(ec.ECDH(), eph_key)
-        symmetric_key = sha256(shared_key + b'\x00\x00\x00\x01' + data[5:62])
-        ciper_txt = data[62:72]
-        auth_tag = data[72:]
-    elif len(data) == 89:
-        confidence = int.from_bytes(data[4:6], byteorder="big")
-        eph_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP224R1(), data[6:63])
-        shared_key = ec.derive_private_key(priv, ec.SECP224R1(), default_backend()).exchange(ec.ECDH(), eph_key)
-        symmetric_key = sha256(shared_key + b'\x00\x00\x00\x01' + data[6:63])
-        ciper_txt = data[63:73]
-        auth_tag = data[73:]
+async def private_keys_to_hashed_keys(private_keys: set) -> ({}, set):
+    # Map hashed advertisement key -> private key, return the private keys that failed to derive as well. New keys
+    # are derived and looked up in reports.db, off the event loop.
+    pairs = await asyncio.to_thread(key_map.lookup_many, private_keys)
+    key_dict = {pairs[key][0]: key for key in pairs}
+    return key_dict, set(private_keys) - set(pairs)
+
+
+# Reports are decrypted in batches of this size while the upload is still being parsed
+DECRYPT_BATCH_SIZE = 2048
+
+
+async def decrypt_reports(reports: list, private_keys: {}) -> (list, int):
+    # Decrypted payloads of reports, private_keys maps their ids to private keys. Cached payloads skip the crypto
+    # and repeated payloads are decrypted once. Returns the results and how many were served from the cache.
+    keys = [DecryptCache.key(report['payload'], private_keys[report['id']]) for report in reports]
+    cached = await asyncio.to_thread(decrypt_cache.get_many, keys)
+    pending = {}
+    for report, key in zip(reports, keys):
+        if key not in cached and key not in pending:
+            pending[key] = report
+    decrypted = {}
+    if pending:
+        with stage_timer("decrypt"):
+            results = await decryptor.decrypt_async(
+                [(report['payload'], private_keys[report['id']]) for report in pending.values()])
+        decrypted = dict(zip(pending, results))
+        await asyncio.to_thread(decrypt_cache.put_many,
+                                [(key, pending[key]['id'], result) for key, result in decrypted.items()])
+    return [cached[key] if key in cached else decrypted[key] for key in keys], \
+        sum(1 for key in keys if key in cached)
+
+
+async def decrypt_report_batch(batch: list, key_dict: {}, decrypt_stats: {} = None) -> list:
+    # Malformed payloads are answered without a round trip to the decrypt workers
+    triage = triage_reports([report['payload'] for report in batch], dedupe=False)
+    pending = [report for report, status in zip(batch, triage['status']) if status == KEEP]
+    results, cached = await decrypt_reports(pending, key_dict)
+    if decrypt_stats is not None:
+        decrypt_stats['reports'] = decrypt_stats.get('reports', 0) + len(batch)
+        decrypt_stats['cached'] = decrypt_stats.get('cached', 0) + cached
+    decrypted = 0
+    for report, clear_text in zip(pending, results):
+        report['decrypted_payload'] = clear_text
+        decrypted += clear_text['decrypt_success']
+    REPORTS_DECRYPTED.inc(decrypted)
+    REPORTS_FAILED.labels("decrypt").inc(len(pending) - decrypted)
+    REPORTS_FAILED.labels("malformed").inc(len(batch) - len(pending))
+    for report, status in zip(batch, triage['status']):
+        if status == MALFORMED:
+            report['decrypted_payload'] = {'decrypt_success': False, 'fail_reason': 'Malformed Payload'}
+    return batch
+
+
+class UploadError(Exception):
+    # An uploaded fetch response that is answered with a 400, the message is the error sent back
+    pass
+
+
+def check_upload_status(parser: ReportStreamParser):
+    status = parser.fields.get('statusCode')
+    if status is not None and status != '200':
+        raise UploadError(f"Upstream informed an error. {status}")
+
+
+def next_uploaded_report(reports):
+    # The next report of the upload, None once the results are exhausted
+    try:
+        report = next(reports, None)
+    except ValueError as e:
+        logging.error(f"JSON Decode Failed: {e}")
+        raise UploadError("Invalid JSON Format, Report Decode Failed") from e
+    if report is not None and not (isinstance(report, dict) and 'id' in report):
+        logging.error(f"JSON Decode Failed: report without an id")
+        raise UploadError("Invalid JSON Format, Report Decode Failed")
+    return report
+
+
+async def iter_decrypted_reports(parser: ReportStreamParser, key_dict: {}, invalid_reports: set,
+                                 decrypt_stats: {} = None):
+    # Walk the uploaded results as they are parsed, reports without a matching private key pass through as is.
+    # decrypt_stats, when given, counts the reports decrypted and how many of them came from the decrypt cache.
+    # An upload that is malformed or carries an upstream error raises UploadError, as soon as that is known.
+    batch = []
+    # Parsing is interleaved with decryption, only the time spent inside the parser counts towards the parse stage
+    reports = parser.reports()
+    parse_seconds = 0.0
+    while True:
+        started = time.perf_counter()
+        report = next_uploaded_report(reports)
+        parse_seconds += time.perf_counter() - started
+        check_upload_status(parser)
+        if report is None:
+            break
+        logging.debug(f"Processing {report}")
+        if report['id'] not in key_dict and keystore is not None:
+            entry = keystore.get(report['id'])
+            if entry is not None:
+                key_dict[report['id']] = entry[1]
+        if report['id'] in key_dict:
+            batch.append(report)
+            if len(batch) >= DECRYPT_BATCH_SIZE:
+                for decrypted in await decrypt_report_batch(batch, key_dict, decrypt_stats):
+                    yield decrypted
+                batch = []
+        else:
+            invalid_reports.add(report['id'])
+            yield report
+    STAGE_SECONDS.labels("parse").observe(parse_seconds)
+    if batch:
+        for decrypted in await decrypt_report_batch(batch, key_dict, decrypt_stats):
+            yield decrypted
+    if not parser.has_results or 'statusCode' not in parser.fields:
+        logging.error(f"JSON Decode Failed: upload has no statusCode or results")
+        raise UploadError("Invalid JSON Format, Report Decode Failed")
+
+
+async def collect_decrypted_reports(reports: UploadFile, key_dict: {}):
+    # Returns (reports grouped by hashed key, hashed keys without a private key, decrypt counts), or the
+    # JSONResponse to send
+    valid_reports = {}
+    invalid_reports = set()
+    decrypt_stats = {'reports': 0, 'cached': 0}
+    parser = ReportStreamParser(reports.file)
+    try:
+        async for report in iter_decrypted_reports(parser, key_dict, invalid_reports, decrypt_stats):
+            valid_reports.setdefault(report['id'], []).append(report)
+    except UploadError as e:
+        return JSONResponse(
+            content={"error": str(e)},
+            status_code=400)
+
+    if len(valid_reports) == 0:
+        return JSONResponse(
+            content={"error": f"No valid reports found"},
+            status_code=400)
+
+    return valid_reports, invalid_reports, decrypt_stats
+
+
+async def stream_decrypted_reports(reports: UploadFile, key_dict: {}, skip_invalid: bool):
+    # NDJSON body: one report per line, then a summary line, or an error line if the upload turns out invalid
+    invalid_reports = set()
+    decrypt_stats = {'reports': 0, 'cached': 0}
+    parser = ReportStreamParser(reports.file)
+    count = 0
+    try:
+        async for report in iter_decrypted_reports(parser, key_dict, invalid_reports, decrypt_stats):
+            if report['id'] in key_dict or skip_invalid:
+                count += 1
+                yield json.dumps(report, separators=(',', ':')) + "\n"
+    except UploadError as e:
+        yield json.dumps({"error": str(e)}) + "\n"
+        return
+
+    if len(invalid_reports) > 0 and not skip_invalid:
+        yield json.dumps({"error": f"Invalid Key(s): {invalid_reports}", "reports": count,
+                          "cached": decrypt_stats['cached']}) + "\n"
     else:
-        return {'decrypt_success': False, 'fail_reason': 'Invalid Payload Length'}
-
-    iv = symmetric_key[16:]
-    decryption_key = symmetric_key[:16]
-    clear_text = decrypt(ciper_txt, algorithms.AES(decryption_key), modes.GCM(iv, auth_tag))
-
-    result = {}
-    latitude = struct.unpack(">i", clear_text[0:4])[0] / 10000000.0
-    longitude = struct.unpack(">i", clear_text[4:8])[0] / 10000000.0
-    horizontal_accuracy = int.from_bytes(clear_text[8:9], byteorder="big")
-    status = int.from_bytes(clear_text[9:10], byteorder="big")
-
-    result['timestamp'] = timestamp
-    result['isodatetime'] = datetime.datetime.fromtimestamp(timestamp).isoformat()
-    result['lat'] = latitude
-    result['lon'] = longitude
-    result['confidence'] = confidence
-    result['status'] = status
-    result['horizontal_accuracy'] = horizontal_accuracy
-    result['decrypt_success'] = True
-    result['fail_reason'] = ''
-    return result
+        yield json.dumps({"success": f"Decrypted reports streamed", "reports": count,
+                          "cached": decrypt_stats['cached']}) + "\n"
 
 
 def input_sanitize(input_str: str) -> str:
@@ -207,7 +436,33 @@ def input_sanitize(input_str: str) -> str:
     return ""
 
 
-def get_report_from_upstream(advertisement_keys: str, hours: int) -> {}:
+async def fetch_reports(advertisement_keys: list, hours: int) -> {}:
+    unix_epoch = int(datetime.datetime.now().timestamp())
+    start_date = unix_epoch - (60 * 60 * hours)
+
+    # Anisette generation may block on disk or the local anisette server, keep it off the event loop
+    headers = await asyncio.to_thread(generate_anisette_headers)
+    return await upstream.fetch_reports(advertisement_keys, start_date * 1000, unix_epoch * 1000, headers=headers)
+
+
+async def cached_fetch_reports(advertisement_keys: list, hours: int) -> Response:
+    # Identical (keys, hours) queries share one in-flight upstream call and recent responses are reused
+    advertisement_keys = sorted(set(advertisement_keys))
+    try:
+        reports, cache_status, age = await fetch_cache.get_or_fetch(
+            (tuple(advertisement_keys), hours), lambda: fetch_reports(advertisement_keys, hours))
+    except UpstreamError as e:
+        return JSONResponse(
+            content={"error": str(e)},
+            status_code=e.status_code)
+
+    return JSONResponse(
+        content=reports,
+        headers={"X-Cache": cache_status, "Age": str(int(age)),
+                 "Cache-Control": f"private, max-age={max(0, int(fetch_cache.ttl - age))}"})
+
+
+async def get_report_from_upstream(advertisement_keys: str, hours: int) -> {}:
     re_exp = r"^[-A-Za-z0-9+/]*={0,3}$"
     advertisement_keys_list = []
     advertisement_keys_invalid_list = set()
@@ -229,19 +484,10 @@ def get_report_from_upstream(advertisement_keys: str, hours: int) -> {}:
             content={"error": f"No valid Hashed Advertisement Base64 Key(s) found"},
             status_code=400)
 
-    unix_epoch = int(datetime.datetime.now().timestamp())
-    start_date = unix_epoch - (60 * 60 * hours)
-    data = {"search": [{"startDate": start_date * 1000, "endDate": unix_epoch * 1000, "ids": advertisement_keys_list}]}
-
-    r = requests.post("https://gateway.icloud.com/acsnservice/fetch",
-                      auth=(dsid, searchPartyToken),
-                      headers=generate_anisette_headers(),
-                      json=data)
+    return await cached_fetch_reports(advertisement_keys_list, hours)
 
-    return json.loads(r.content.decode(encoding='utf-8'))
 
-
-@app.post("/SingleDeviceEncryptedReports/", summary="Retrieve reports for one device at a time.")
+@router.post("/SingleDeviceEncryptedReports/", summary="Retrieve reports for one device at a time.")
 async def single_device_encrypted_reports(
         advertisement_key: str = Query(
             description="Advertisement Key. Hashed public key in Base64 or HexString format",
@@ -259,21 +505,11 @@ async def single_device_encrypted_reports(
 
     if len(advertisement_key_san) == 64:
         advertisement_key_san = base64.b64encode(bytes.fromhex(advertisement_key_san)).decode("ascii")
-    unix_epoch = int(datetime.datetime.now().timestamp())
-    start_date = unix_epoch - (60 * 60 * hours)
 
-    data = {"search": [{"startDate": start_date * 1000, "endDate": unix_epoch * 1000,
-                        "ids": [advertisement_key_san]}]}
+    return await cached_fetch_reports([advertisement_key_san], hours)
 
-    r = requests.post("https://gateway.icloud.com/acsnservice/fetch",
-                      auth=(dsid, searchPartyToken),
-                      headers=generate_anisette_headers(),
-                      json=data)
 
-    return json.loads(r.content.decode(encoding='utf-8'))
-
-
-@app.post("/MultipleDeviceEncryptedReports/", summary="Retrieve reports for multiple devices at a time.")
+@router.post("/MultipleDeviceEncryptedReports/", summary="Retrieve reports for multiple devices at a time.")
 async def multiple_device_encrypted_reports(
         advertisement_keys: Annotated[str, Body(
             description="Hashed Advertisement Base64 Key. Separate each key by a comma.",
@@ -295,26 +531,29 @@ async def multiple_device_encrypted_reports(
             return JSONResponse(
                 content={"error": f"Invalid Hashed Advertisement Key(s): {advertisement_keys}"},
                 status_code=400)
-    return get_report_from_upstream(advertisement_keys, hours)
+    return await get_report_from_upstream(advertisement_keys, hours)
 
 
-@app.post("/SingleDecrypt/", summary="Decrypt reports for one or many devices.")
+@router.post("/SingleDecrypt/", summary="Decrypt reports for one or many devices.")
 async def report_decrypt_single(
         private_keys: Annotated[str | None, Header(
             description="**Private Key is a secret and shall not be provided to any untrusted website!**")] = None,
         reports: UploadFile = File(..., max_size=5 * 1024 * 1024,
                                    description="The JSON response from MultipleDeviceEncryptedReports or "
                                                "SingleDeviceEncryptedReports"),
-        skip_invalid: bool = Query(description="Ignore report and private mismatch", default=False)):
+        skip_invalid: bool = Query(description="Ignore report and private mismatch", default=False),
+        output_format: str = Query("json", description="json, or ndjson to stream one decrypted report per line",
+                                   regex=r"^(json|ndjson)$")):
     """
     Upload the JSON response from MultipleDeviceEncryptedReports or SingleDeviceEncryptedReports,<br>
     and the private key(s) in base64 format to decrypt the reports.<br>
     Choose True or False to skip any format invalid private key <br>
+    With output_format ndjson, reports are streamed back one per line as they are decrypted, followed by a
+    summary line. Errors found after streaming started are reported on that last line. <br>
     """
     valid_private_keys = set()
     invalid_private_keys = set()
 
-    key_dict = {}
     for key in private_keys.strip().split(','):
 
         key_san = input_sanitize(key)
@@ -328,79 +567,46 @@ async def report_decrypt_single(
             else:
                 invalid_private_keys.add(key)
 
-    for key in valid_private_keys:
-        try:
-            key_dict[private_to_hashed_key(key)] = key
-        except Exception as e:
-            logging.error(f"Private Key Decode Failed: {e}", exc_info=True)
-            invalid_private_keys.add(key)
-
-    valid_reports = {}
-    invalid_reports = set()
-
-    try:
-        loaded_reports = json.loads(reports.file.read())
-        logging.debug("JSON Loaded")
-        if loaded_reports['statusCode'] == '200':
-            logging.debug("Status Code 200")
-        else:
-            return JSONResponse(
-                content={"error": f"Upstream informed an error. {loaded_reports['statusCode']}"},
-                status_code=400)
-
-        reports = loaded_reports['results']
-        for report in reports:
-            logging.debug(f"Processing {report}")
-            if report['id'] in valid_reports:
-                valid_reports[report['id']].append(report)
-            else:
-                logging.debug(f"ID is not in dict, creating list and adding ...")
-                valid_reports[report['id']] = []
-                valid_reports[report['id']].append(report)
-
-    except Exception as e:
-        logging.error(f"JSON Decode Failed: {e}", exc_info=True)
-        return JSONResponse(
-            content={"error": f"Invalid JSON Format, Report Decode Failed"},
-            status_code=400)
+    key_dict, failed_private_keys = await private_keys_to_hashed_keys(valid_private_keys)
+    invalid_private_keys.update(failed_private_keys)
 
-    if len(valid_reports) == 0:
-        return JSONResponse(
-            content={"error": f"No valid reports found"},
-            status_code=400)
+    if output_format == "ndjson":
+        return StreamingResponse(stream_decrypted_reports(reports, key_dict, skip_invalid),
+                                 media_type="application/x-ndjson")
 
-    for hash_key in valid_reports:
-        if hash_key in key_dict:
-            for report in valid_reports.get(hash_key):
-                clear_text = decrypt_payload(report['payload'], key_dict[hash_key])
-                report['decrypted_payload'] = clear_text
-        else:
-            invalid_reports.add(hash_key)
+    collected = await collect_decrypted_reports(reports, key_dict)
+    if isinstance(collected, JSONResponse):
+        return collected
+    valid_reports, invalid_reports, decrypt_stats = collected
 
     if len(invalid_reports) > 0 and not skip_invalid:
         return JSONResponse(
             content={"error": f"Invalid Key(s): {invalid_reports}"},
             status_code=400)
 
-    return valid_reports
+    # How many of the decrypted reports were served from the decrypt cache
+    return JSONResponse(content=valid_reports, headers={"X-Decrypt-Cache-Hits": str(decrypt_stats['cached'])})
 
 
-@app.post("/MultipleDecrypt/", summary="Decrypt reports for one or many devices.")
+@router.post("/MultipleDecrypt/", summary="Decrypt reports for one or many devices.")
 async def report_decrypt_multiple(
         private_keys: UploadFile = File(..., description="File containing private keys, one per line"),
         reports: UploadFile = File(...,
                                    description="The JSON response from MultipleDeviceEncryptedReports or SingleDeviceEncryptedReports"),
-        skip_invalid: bool = Form(False, description="Ignore report and private key mismatch")
+        skip_invalid: bool = Form(False, description="Ignore report and private key mismatch"),
+        output_format: str = Form("json", description="json, or ndjson to stream one decrypted report per line",
+                                  regex=r"^(json|ndjson)$")
 ):
     """
     Upload the JSON response from MultipleDeviceEncryptedReports or SingleDeviceEncryptedReports,<br>
     and the private key(s) in base64 format to decrypt the reports.<br>
     Choose True or False to skip any format invalid private key <br>
+    With output_format ndjson, reports are streamed back one per line as they are decrypted, followed by a
+    summary line. Errors found after streaming started are reported on that last line. <br>
     """
     valid_private_keys = set()
     invalid_private_keys = set()
 
-    key_dict = {}
     # Read private keys from file
     private_keys_content = await private_keys.read()
     private_keys_list = private_keys_content.decode().strip().split('\n')
@@ -417,52 +623,17 @@ async def report_decrypt_multiple(
                 invalid_private_keys.add(key)
                 logging.debug(f"Invalid Key kml, length {len(key_san)}")
 
-    valid_reports = {}
-    invalid_reports = set()
-
-    try:
-        loaded_reports = json.loads(reports.file.read())
-        logging.debug("JSON Loaded")
-        if loaded_reports['statusCode'] == '200':
-            logging.debug("Status Code 200")
-        else:
-            return JSONResponse(
-                content={"error": f"Upstream informed an error. {loaded_reports['statusCode']}"},
-                status_code=400)
-
-        reports = loaded_reports['results']
-        for report in reports:
-            logging.debug(f"Processing {report}")
-            if report['id'] in valid_reports:
-                valid_reports[report['id']].append(report)
-            else:
-                logging.debug(f"ID is not in dict, creating list and adding ...")
-                valid_reports[report['id']] = []
-                valid_reports[report['id']].append(report)
+    key_dict, failed_private_keys = await private_keys_to_hashed_keys(valid_private_keys)
+    invalid_private_keys.update(failed_private_keys)
 
-    except Exception as e:
-        logging.error(f"JSON Decode Failed: {e}", exc_info=True)
-        return JSONResponse(
-            content={"error": f"Invalid JSON Format, Report Decode Failed"},
-            status_code=400)
+    if output_format == "ndjson":
+        return StreamingResponse(stream_decrypted_reports(reports, key_dict, skip_invalid),
+                                 media_type="application/x-ndjson")
 
-    if len(valid_reports) == 0:
-        return JSONResponse(
-            content={"error": f"No valid reports found"},
-            status_code=400)
-    for key in valid_private_keys:
-        try:
-            key_dict[private_to_hashed_key(key)] = key
-        except Exception as e:
-            logging.error(f"Private Key Decode Failed: {e}", exc_info=True)
-            invalid_private_keys.add(key)
-    for hash_key in valid_reports:
-        if hash_key in key_dict:
-            for report in valid_reports.get(hash_key):
-                clear_text = decrypt_payload(report['payload'], key_dict[hash_key])
-                report['decrypted_payload'] = clear_text
-        else:
-            invalid_reports.add(hash_key)
+    collected = await collect_decrypted_reports(reports, key_dict)
+    if isinstance(collected, JSONResponse):
+        return collected
+    valid_reports, invalid_reports, decrypt_stats = collected
 
     if len(invalid_reports) > 0 and not skip_invalid:
         return JSONResponse(
@@ -474,25 +645,61 @@ async def report_decrypt_multiple(
             content={"error": f"No valid reports found"},
             status_code=400)
 
-    return valid_reports
+    return JSONResponse(content=valid_reports, headers={"X-Decrypt-Cache-Hits": str(decrypt_stats['cached'])})
+
+
+# Placemarks written per chunk of the streamed document
+GEO_FLUSH_PLACEMARKS = 500
 
 
-@app.post("/MultiDecryptToKML/", summary="Decrypt reports for one or many devices.")
+def placemark_fields(report: {}, tz) -> tuple | None:
+    # (name, when, lat, lon, properties) of a decrypted report, None when it did not decrypt
+    payload = report.get('decrypted_payload')
+    if payload is None or not payload['decrypt_success']:
+        return None
+    timestamp = payload['timestamp']
+
+    # Check if timestamp is in milliseconds
+    if timestamp > 1e12:  # If timestamp is in milliseconds
+        timestamp = timestamp / 1000  # Convert to seconds
+
+    local_time = datetime.datetime.fromtimestamp(timestamp, tz)
+    return (local_time.strftime('%Y-%m-%d %H:%M:%S %Z'), local_time.isoformat(), payload['lat'], payload['lon'],
+            {"id": report['id'], "confidence": payload['confidence']})
+
+
+@router.post("/MultiDecryptToKML/", summary="Decrypt reports for one or many devices.")
 async def report_decrypt_kml(
         private_keys: UploadFile = File(..., description="File containing private keys, one per line"),
         reports: UploadFile = File(...,
                                    description="The JSON response from MultipleDeviceEncryptedReports or SingleDeviceEncryptedReports"),
-        skip_invalid: bool = Form(False, description="Ignore report and private key mismatch")
+        skip_invalid: bool = Form(False, description="Ignore report and private key mismatch"),
+        output_format: str = Form("kml", description="kml, or geojson for a GeoJSON FeatureCollection"),
+        timezone: str | None = Form(None, description="IANA time zone used for placemark names and timestamps, "
+                                                       "default --timezone")
 ):
     """
     Upload the JSON response from MultipleDeviceEncryptedReports or SingleDeviceEncryptedReports,<br>
     and the private key(s) in base64 format to decrypt the reports.<br>
     Choose True or False to skip any format invalid private key <br>
+    The document is streamed placemark by placemark. An error found after the first placemark was sent is
+    reported at the end of the document, as a comment in KML or an "error" member in GeoJSON.<br>
     """
+    if output_format not in ("kml", "geojson"):
+        return JSONResponse(
+            content={"error": f"Unsupported output format: {output_format}"},
+            status_code=400)
+    timezone = timezone or args.timezone
+    try:
+        tz = pytz.timezone(timezone)
+    except pytz.UnknownTimeZoneError:
+        return JSONResponse(
+            content={"error": f"Unknown time zone: {timezone}"},
+            status_code=400)
+
     valid_private_keys = set()
     invalid_private_keys = set()
 
-    key_dict = {}
     # Read private keys from file
     private_keys_content = await private_keys.read()
     private_keys_list = private_keys_content.decode().strip().split('\n')
@@ -509,101 +716,71 @@ async def report_decrypt_kml(
                 invalid_private_keys.add(key)
                 logging.debug(f"Invalid Key kml, length {len(key_san)}")
 
-    valid_reports = {}
+    key_dict, failed_private_keys = await private_keys_to_hashed_keys(valid_private_keys)
+    invalid_private_keys.update(failed_private_keys)
+
+    writer = GeoJsonWriter() if output_format == "geojson" else KmlWriter()
     invalid_reports = set()
+    parser = ReportStreamParser(reports.file)
+    decrypted = iter_decrypted_reports(parser, key_dict, invalid_reports)
 
+    # Hold the response until the first placemark, so empty or invalid uploads are still answered with a 400
+    first = None
     try:
-        loaded_reports = json.loads(reports.file.read())
-        logging.debug("JSON Loaded")
-        if loaded_reports['statusCode'] == '200':
-            logging.debug("Status Code 200")
-        else:
-            return JSONResponse(
-                content={"error": f"Upstream informed an error. {loaded_reports['statusCode']}"},
-                status_code=400)
-
-        reports = loaded_reports['results']
-        for report in reports:
-            logging.debug(f"Processing {report}")
-            if report['id'] in valid_reports:
-                valid_reports[report['id']].append(report)
-            else:
-                logging.debug(f"ID is not in dict, creating list and adding ...")
-                valid_reports[report['id']] = []
-                valid_reports[report['id']].append(report)
-
-    except Exception as e:
-        logging.error(f"JSON Decode Failed: {e}", exc_info=True)
+        async for report in decrypted:
+            if report['id'] not in key_dict:
+                continue
+            if len(invalid_reports) > 0 and not skip_invalid:
+                # The upload is answered with a 400, read on only to name every invalid key in it
+                continue
+            first = placemark_fields(report, tz)
+            if first is not None:
+                break
+    except UploadError as e:
         return JSONResponse(
-            content={"error": f"Invalid JSON Format, Report Decode Failed"},
+            content={"error": str(e)},
             status_code=400)
 
-    if len(valid_reports) == 0:
+    if first is None:
+        if len(invalid_reports) > 0 and not skip_invalid:
+            return JSONResponse(
+                content={"error": f"Invalid Key(s): {invalid_reports}"},
+                status_code=400)
         return JSONResponse(
             content={"error": f"No valid reports found"},
             status_code=400)
-    for key in valid_private_keys:
+
+    async def document():
+        parts = [writer.header(), writer.placemark(*first)]
+        error = None
         try:
-            key_dict[private_to_hashed_key(key)] = key
-        except Exception as e:
-            logging.error(f"Private Key Decode Failed: {e}", exc_info=True)
-            invalid_private_keys.add(key)
-    for hash_key in valid_reports:
-        if hash_key in key_dict:
-            for report in valid_reports.get(hash_key):
-                clear_text = decrypt_payload(report['payload'], key_dict[hash_key])
-                report['decrypted_payload'] = clear_text
+            async for report in decrypted:
+                if report['id'] not in key_dict:
+                    continue
+                fields = placemark_fields(report, tz)
+                if fields is not None:
+                    parts.append(writer.placemark(*fields))
+                if len(parts) >= GEO_FLUSH_PLACEMARKS:
+                    yield ''.join(parts)
+                    parts = []
+        except UploadError as e:
+            error = str(e)
         else:
-            invalid_reports.add(hash_key)
-
-    if len(invalid_reports) > 0 and not skip_invalid:
-        return JSONResponse(
-            content={"error": f"Invalid Key(s): {invalid_reports}"},
-            status_code=400)
-
-    if len(valid_reports) == 0:
-        return JSONResponse(
-            content={"error": f"No valid reports found"},
-            status_code=400)
-
-    # Create a new KML object
-    kml = simplekml.Kml()
-    ny_tz = timezone('America/New_York')
-
-    # Locate a collection of reports by using Base64 of Hashed Public Key
-    for hash_key in valid_reports:
-        for report in valid_reports.get(hash_key):
-            payload = report['decrypted_payload']
-            timestamp = payload['timestamp']
-            confidence = payload['confidence']
-
-            # Check if timestamp is in milliseconds
-            if timestamp > 1e12:  # If timestamp is in milliseconds
-                timestamp = timestamp / 1000  # Convert to seconds
-
-            utc_time = datetime.datetime.utcfromtimestamp(timestamp)
-            utc_time = utc_time.replace(tzinfo=timezone('UTC'))
-            lat = payload['lat']
-            lon = payload['lon']
-
-            ny_time = utc_time.astimezone(ny_tz)
-            time_str = ny_time.strftime('%Y-%m-%d %H:%M:%S %Z')
-
-            # Create a placemark for each point
-            pnt = kml.newpoint(name=time_str, coords=[(lon, lat)])
-            pnt.timestamp.when = ny_time.isoformat()  # Set the timestamp for the placemark
-
-    kml_string = kml.kml()
-    return Response(
-        content=kml_string,
-        media_type="application/vnd.google-earth.kml+kml",
+            if len(invalid_reports) > 0 and not skip_invalid:
+                error = f"Invalid Key(s): {invalid_reports}"
+        parts.append(writer.footer(error))
+        yield ''.join(parts)
+
+    return StreamingResponse(
+        document(),
+        media_type=writer.media_type,
         headers={
-            "Content-Disposition": "attachment; filename=report.kml"
+            "Content-Disposition": f"attachment; filename=report.{writer.extension}"
         }
     )
 
 
-@app.post("/KeyToMonitor/", summary="Add a key to monitor db.")
+@router.post("/KeyToMonitor/", summary="Add a key to monitor db.")
 async def key_to_monitor(
         private_key: Annotated[str | None, Body(
             description="**Private Key is a secret and shall not be provided to any untrusted website!**")] = None,
@@ -651,174 +828,304 @@ async def key_to_monitor(
                   f"mqtt_port: {mqtt_port}, mqtt_publish_encryption_key length: {len(mqtt_publish_encryption_key)}, \n"
                   f"mqtt_username: {mqtt_username}, mqtt_userpass length: {len(mqtt_userpass)}, mqtt_over_tls: {mqtt_over_tls}")
 
-    for key in valid_private_keys:
-        query = "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        parameters = (private_to_hashed_key(key), key, friendly_name, mqtt_server, mqtt_port, mqtt_over_tls,
-                      mqtt_publish_encryption_key, mqtt_username, mqtt_userpass, mqtt_topic)
-        _sq3.execute(query, parameters)
+    key_dict, failed_private_keys = await private_keys_to_hashed_keys(valid_private_keys)
+    if len(key_dict) == 0:
+        return JSONResponse(
+            content={"error": f"No valid Private Key(s) found"},
+            status_code=400)
 
-    sq3db.commit()
+    store.upsert_tags([(hash_key, key, friendly_name, mqtt_server, mqtt_port, mqtt_over_tls,
+                        mqtt_publish_encryption_key, mqtt_username, mqtt_userpass, mqtt_topic)
+                       for hash_key, key in key_dict.items()])
     return JSONResponse(
         content={"success": f"Private key added to monitor db"},
         status_code=200)
 
 
+# Re-request this much before each tag's watermark, reports published late are still picked up
+SYNC_OVERLAP_MS = 10 * 60 * 1000
+# Apple keeps reports for about a week, never ask for more than that
+SYNC_MAX_WINDOW_MS = 7 * 24 * 60 * 60 * 1000
+# Window starts are rounded down to this, so tags synced together share one upstream search
+SYNC_BUCKET_MS = 5 * 60 * 1000
+
+
 # Get the reports from the upstream and decrypt them, save the result to the reports table
-def sync_latest_decrypted_reports():
-    hash_adv_keys = _sq3.execute("SELECT hash_adv_key FROM tags")
-    hash_adv_keys = set([item[0] for item in hash_adv_keys])
+async def sync_latest_decrypted_reports(hash_adv_keys=None) -> {}:
+    private_keys = store.tag_private_keys()
+    if hash_adv_keys is not None:
+        private_keys = {hash_key: key for hash_key, key in private_keys.items() if hash_key in hash_adv_keys}
+    hash_adv_keys = set(private_keys)
+    stats = {"fetched": 0, "new": 0, "duplicate": 0, "failed": 0, "cached": 0}
 
     logging.debug(f"hash_adv_keys: {hash_adv_keys}")
     if len(hash_adv_keys) == 0:
         logging.error(f"No Report available, or Upstream informed an error.", exc_info=True)
-        return
-
-    reports = get_report_from_upstream(",".join(hash_adv_keys), 1)
-
-    if "results" in reports:
-        for report in reports["results"]:
-            if report["id"] in hash_adv_keys:
-                clear_text = decrypt_payload(report['payload'], _sq3.execute(
-                    "SELECT private_key FROM tags WHERE hash_adv_key = ?", (report["id"],)).fetchone()[0])
-
-                # id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT,
-                # id TEXT, statusCode INTEGER, lat TEXT, lon TEXT, conf INTEGER
-
-                logging.debug(report)
-                logging.debug(clear_text)
-                query = "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                parameters = (report["id"][:7], clear_text['timestamp'], report['datePublished'], report['payload'],
-                              report['id'], clear_text['status'], clear_text['lat'], clear_text['lon'],
-                              clear_text['confidence'])
-                _sq3.execute(query, parameters)
-        sq3db.commit()
-    else:
-        logging.error(f"Upstream informed an error. {reports['statusCode']}", exc_info=True)
-
+        return stats
+
+    # Each tag only asks for the window since its last successful sync, first syncs look back one hour
+    end_date = int(datetime.datetime.now().timestamp()) * 1000
+    with stage_timer("sqlite"):
+        synced_until = store.synced_until()
+    windows = {}
+    for hash_key in hash_adv_keys:
+        if synced_until.get(hash_key):
+            start_date = max(synced_until[hash_key] - SYNC_OVERLAP_MS, end_date - SYNC_MAX_WINDOW_MS)
+        else:
+            start_date = end_date - 60 * 60 * 1000
+        windows.setdefault(start_date - start_date % SYNC_BUCKET_MS, []).append(hash_key)
+
+    headers = await asyncio.to_thread(generate_anisette_headers)
+    responses = await asyncio.gather(
+        *(upstream.fetch_reports(keys, start_date, end_date, headers=headers)
+          for start_date, keys in windows.items()),
+        return_exceptions=True)
+
+    fetched = []
+    synced_keys = set()
+    for keys, reports in zip(windows.values(), responses):
+        if isinstance(reports, UpstreamError):
+            logging.error(f"Upstream request failed for {len(keys)} key(s). {reports}")
+            continue
+        if isinstance(reports, BaseException):
+            raise reports
+        if "results" not in reports:
+            logging.error(f"Upstream informed an error. {reports.get('statusCode')}")
+            continue
+
+        failed_keys = set()
+        for failure in reports.get("failedChunks", []):
+            logging.error(f"Upstream request failed for {len(failure['ids'])} key(s). {failure['error']}")
+            failed_keys.update(failure['ids'])
+        synced_keys.update(set(keys) - failed_keys)
+        fetched.extend(report for report in reports["results"] if report["id"] in hash_adv_keys)
+    stats["fetched"] = len(fetched)
+    REPORTS_FETCHED.inc(len(fetched))
+
+    # Drop malformed payloads, payloads that are already stored, or repeated across overlapping windows, before any ECDH
+    triage = triage_reports([report["payload"] for report in fetched], ids=[report["id"] for report in fetched])
+    with stage_timer("sqlite"):
+        stored = store.stored_payloads(list({report["id"] for report in fetched}),
+                                       min([report['datePublished'] for report in fetched], default=0))
+    counts = {hash_key: {"new": 0, "duplicate": 0} for hash_key in synced_keys}
+    pending = []
+    for report, status in zip(fetched, triage['status']):
+        if status == MALFORMED:
+            logging.error(f"Malformed report for {report['id']}")
+            stats["failed"] += 1
+            REPORTS_FAILED.labels("malformed").inc()
+        elif status != KEEP or (report["id"], report["payload"]) in stored:
+            stats["duplicate"] += 1
+            counts[report["id"]]["duplicate"] += 1
+        else:
+            pending.append(report)
+
+    results, stats["cached"] = await decrypt_reports(pending, private_keys)
+
+    rows = []
+    watermarks = {}
+    for report, clear_text in zip(pending, results):
+        if not clear_text['decrypt_success']:
+            logging.error(f"Decrypt Failed for {report['id']}: {clear_text['fail_reason']}")
+            stats["failed"] += 1
+            REPORTS_FAILED.labels("decrypt").inc()
+            continue
+
+        # id_short TEXT, timestamp INTEGER, datePublished INTEGER, payload TEXT,
+        # id TEXT, statusCode INTEGER, lat REAL, lon REAL, conf INTEGER
+
+        logging.debug(report)
+        logging.debug(clear_text)
+        rows.append((report["id"][:7], clear_text['timestamp'], report['datePublished'], report['payload'],
+                     report['id'], clear_text['status'], clear_text['lat'], clear_text['lon'],
+                     clear_text['confidence']))
+        stats["new"] += 1
+        counts[report["id"]]["new"] += 1
+        date_published, timestamp = watermarks.get(report["id"], (0, 0))
+        watermarks[report["id"]] = (max(date_published, report['datePublished']),
+                                    max(timestamp, clear_text['timestamp']))
+
+    REPORTS_DECRYPTED.inc(len(rows))
+    sync_rows = []
+    for hash_key, count in counts.items():
+        date_published, timestamp = watermarks.get(hash_key, (None, None))
+        sync_rows.append((hash_key, date_published, timestamp, end_date, count["new"], count["duplicate"]))
+    with stage_timer("sqlite"):
+        store.insert_reports(rows)
+        store.update_sync_state(sync_rows)
+
+    logging.info(f"Synced {stats['fetched']} report(s) for {len(synced_keys)} tag(s): {stats['new']} new "
+                 f"({stats['cached']} from the decrypt cache), {stats['duplicate']} duplicate, "
+                 f"{stats['failed']} failed to decrypt")
+    return stats
+
+
+async def publish_latest_locations(hash_adv_keys=None) -> {}:
+    # hash_adv_key, friendly_name, mqtt_server, mqtt_port, lat, lon, timestamp, mqtt_over_tls,
+    # mqtt_publish_encryption_key, mqtt_username, mqtt_userpass, mqtt_topic, conf
+    with stage_timer("sqlite"):
+        tags = store.latest_locations(hash_adv_keys)
+    logging.debug(f"tags to send. {tags}")
 
-@app.post("/Publish_MQTT/", summary="Trigger a publish action to MQTT Servers")
+    messages = []
+    for tag in tags:
+        # https://owntracks.org/booklet/tech/json/#_typelocation
+        report = {"_type": "location",
+                  "lat": float(tag[4]),
+                  "lon": float(tag[5]),
+                  "tst": float(tag[6]),
+                  "tid": tag[1]
+                  }
+        # "+" and "/" are MQTT wildcard and level characters, base64 keys may hold both
+        escape_keyname = tag[0].replace("/", "_").replace("+", "-")
+        logging.info(f"Publishing MQTT for {tag[0]} to {tag[2]}")
+        messages.append({"server": tag[2], "port": tag[3], "username": tag[9], "password": tag[10], "tls": tag[7],
+                         "topic": f"owntracks/{tag[9]}/{tag[1]}_{escape_keyname[:4]}",
+                         "payload": json.dumps(report, separators=(',', ':'))})
+
+    if len(messages) == 0:
+        return {"published": 0, "failed": 0}
+    with stage_timer("mqtt"):
+        outcome = await asyncio.to_thread(mqtt_publisher.publish_many, messages)
+    MQTT_PUBLISHES.labels("published").inc(outcome["published"])
+    MQTT_PUBLISHES.labels("failed").inc(outcome["failed"])
+    return outcome
+
+
+async def scheduled_sync(hash_adv_keys: set) -> {}:
+    # Returns the new report count of every tag that synced successfully
+    started = int(datetime.datetime.now().timestamp()) * 1000
+    await sync_latest_decrypted_reports(hash_adv_keys)
+    return {hash_key: new_reports for hash_key, new_reports in store.new_reports_since(started).items()
+            if hash_key in hash_adv_keys}
+
+
+@router.post("/Publish_MQTT/", summary="Trigger a publish action to MQTT Servers")
 async def publish_mqtt():
     """
     When this api is triggered, it will read all the private keys have been register by using the api "KeyToMonitor",
     query the latest reports from Apple, save the reports to database,
     then and publish it to the MQTT server which previously declared and saved in the database.
+    Tags synced within the minimum sync interval are not queried again, their latest location is still published.
     """
 
-    if time.time() - app.last_publish_time < 60:
+    sync_stats = await scheduler.run_due(force=True, publish=False)
+
+    if len(store.latest_locations()) == 0:
         return JSONResponse(
-            content={
-                "error": f"Publish MQTT too frequently, please wait for "
-                         f"{int(60 - (time.time() - app.last_publish_time))} seconds"},
+            content={"error": f"No valid report found"},
             status_code=400)
-    else:
-        app.last_publish_time = time.time()
-
-    ca_path = certifi.where()
-    # hash_adv_key TEXT, private_key TEXT, friendly_name TEXT, mqtt_server TEXT, mqtt_port INTEGER, mqtt_over_tls BOOLEAN,
-    # mqtt_publish_encryption_key TEXT, mqtt_username TEXT, mqtt_userpass TEXT, mqtt_topic TEXT
-
-    sync_latest_decrypted_reports()
-
-    sql_query = """
-    WITH RankedReports AS (
-      SELECT
-        hash_adv_key,
-        friendly_name,
-        mqtt_server,
-        mqtt_port,
-        lat,
-        lon,
-        timestamp,
-        mqtt_over_tls,
-        mqtt_publish_encryption_key,
-        mqtt_username,
-        mqtt_userpass,
-        mqtt_topic,
-        conf,
-        ROW_NUMBER() OVER(PARTITION BY hash_adv_key ORDER BY timestamp DESC) AS rn
-      FROM tags
-      JOIN reports ON reports.id = tags.hash_adv_key
-      WHERE lat IS NOT NULL AND lon IS NOT NULL
-    )
-    SELECT
-      hash_adv_key,
-      friendly_name,
-      mqtt_server,
-      mqtt_port,
-      lat,
-      lon,
-      timestamp,
-      mqtt_over_tls,
-      mqtt_publish_encryption_key,
-      mqtt_username,
-      mqtt_userpass,
-      mqtt_topic,
-      conf
-    FROM RankedReports
-    WHERE rn = 1;
+
+    mqtt_stats = await publish_latest_locations()
+    return JSONResponse(
+        content={"success": f"Published MQTT", "sync": sync_stats, "mqtt": mqtt_stats},
+        status_code=200)
+
+
+# Reports read from the database per keyset query while exporting
+EXPORT_PAGE_SIZE = 1000
+
+
+def encode_export_cursor(row: tuple) -> str:
+    # Position behind an exported (rowid, id_short, timestamp, datePublished, payload, id, ...) row
+    return base64.urlsafe_b64encode(json.dumps([row[5], row[2], row[0]]).encode()).decode("ascii")
+
+
+def decode_export_cursor(cursor: str) -> tuple:
+    hash_key, timestamp, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return str(hash_key), int(timestamp), int(rowid)
+
+
+@router.post("/ExportReports/", summary="Export stored reports for keys and a time range.")
+async def export_reports(
+        keys: Annotated[str, Query(
+            description="Hashed advertisement key in Base64 format. Separate each key by a comma.")],
+        start: Annotated[int | None, Query(description="Unix timestamp in seconds, default 7 days ago")] = None,
+        end: Annotated[int | None, Query(description="Unix timestamp in seconds, default now")] = None,
+        output_format: Annotated[str, Query(description="csv, ndjson or parquet")] = "ndjson",
+        limit: Annotated[int | None, Query(
+            description="Return at most this many reports, X-Next-Cursor continues the export", gt=0)] = None,
+        cursor: Annotated[str | None, Query(description="X-Next-Cursor of the previous response")] = None):
     """
-    tags = _sq3.execute(sql_query).fetchall()
+    Stream reports already decrypted and saved by the monitor from the database, no request is made to Apple.<br>
+    Reports are ordered by key, then timestamp. With a limit, the X-Next-Cursor response header is set while more
+    reports remain, pass it as cursor to get the next page.<br>
+    """
+    re_exp = r"^[-A-Za-z0-9+/]*={0,3}$"
 
-    logging.debug(f"tags to send. {tags}")
+    keys_set = set()
+    for key in keys.strip().replace(" ", "").split(','):
+        if len(key) > 0 and re.match(re_exp, key):
+            keys_set.add(key)
 
-    if len(tags) == 0:
+    if len(keys_set) == 0:
         return JSONResponse(
-            content={"error": f"No valid report found"},
+            content={"error": f"No valid Base64 Key(s) found"},
             status_code=400)
 
-    for tag in tags:
-        try:
-            logging.debug(f"\n"
-                          f"tag[0]: {tag[0]} \n"
-                          f"tag[1]: {tag[1]} \n"
-                          f"tag[2]: {tag[2]} \n"
-                          f"tag[3]: {tag[3]} \n"
-                          f"tag[4]: {tag[4]} \n"
-                          f"tag[5]: {tag[5]} \n"
-                          f"tag[6]: {tag[6]} \n"
-                          f"tag[7]: {tag[7]} \n"
-                          f"tag[8]: {tag[8]} \n"
-                          f"tag[9]: {tag[9]} \n"
-                          f"tag[10]: {tag[10]} \n"
-                          f"tag[11]: {tag[11]}")
-
-            # https://owntracks.org/booklet/tech/json/#_typelocation
-            report = {"_type": "location",
-                      "lat": float(tag[4]),
-                      "lon": float(tag[5]),
-                      "tst": float(tag[6]),
-                      "tid": tag[1]
-                      }
-            escape_keyname = tag[0].replace("/", "_")
-
-            if tag[7]:
-                logging.info(f"Publishing MQTT for {tag[0]} to {tag[2]}")
-                publish.single(
-                    topic=f"owntracks/{tag[9]}/{tag[1]}_{escape_keyname[:4]}",
-                    payload=json.dumps(report, separators=(',', ':')),
-                    qos=1, retain=True, hostname=tag[2], client_id=tag[9],
-                    port=int(tag[3]), keepalive=60, will=None, tls={"ca_certs": ca_path},
-                    auth={'username': tag[9], 'password': tag[10]},
-                    transport="tcp")
-
-            else:
-                logging.info(f"Publishing MQTT for {tag[0]} to {tag[2]}")
-                publish.single(
-                    topic=f"owntracks/{tag[9]}/{tag[1]}_{escape_keyname[:4]}",
-                    payload=json.dumps(report, separators=(',', ':')),
-                    qos=1, retain=True, hostname=tag[2], client_id=tag[9],
-                    port=int(tag[3]), keepalive=60, will=None, tls=None,
-                    auth={'username': tag[9], 'password': tag[10]},
-                    transport="tcp")
-        except Exception as e:
-            logging.error(f"Publish MQTT Failed: {e}", exc_info=True)
-            pass
-    return JSONResponse(
-        content={"success": f"Published MQTT"},
-        status_code=200)
+    if output_format not in EXPORT_WRITERS:
+        return JSONResponse(
+            content={"error": f"Unsupported output format: {output_format}"},
+            status_code=400)
+    if output_format == "parquet" and not PARQUET_AVAILABLE:
+        return JSONResponse(
+            content={"error": f"Parquet export requires pyarrow, pip install pyarrow"},
+            status_code=400)
 
+    after = None
+    if cursor:
+        try:
+            after = decode_export_cursor(cursor)
+        except Exception:
+            return JSONResponse(
+                content={"error": f"Invalid cursor"},
+                status_code=400)
 
-@app.post("/Tag_Removal/", summary="Remove everything from Database with given hashed, advertisement, or private key.")
+    unix_epoch = int(datetime.datetime.now().timestamp())
+    start = unix_epoch - 7 * 24 * 60 * 60 if start is None else start
+    end = unix_epoch if end is None else end
+
+    headers = {"Content-Disposition": f"attachment; filename=reports.{output_format}"}
+    writer = EXPORT_WRITERS[output_format]()
+
+    if limit is not None:
+        # Read one report past the limit to know whether another page follows
+        def read_page() -> list:
+            rows = []
+            for page in store.export_reports(keys_set, start, end, page_size=min(limit + 1, EXPORT_PAGE_SIZE),
+                                             after=after):
+                rows.extend(page)
+                if len(rows) > limit:
+                    break
+            return rows
+
+        rows = await asyncio.to_thread(read_page)
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers["X-Next-Cursor"] = encode_export_cursor(rows[-1])
+
+        def body():
+            yield writer.header()
+            yield writer.rows([row[1:] for row in rows])
+            yield writer.footer()
+    else:
+        # A plain generator, Starlette iterates it in worker threads so the queries never block the event loop.
+        # Each step may run on a different thread, so the export has a connection of its own rather than a thread's.
+        def body():
+            conn = store.open_connection()
+            try:
+                yield writer.header()
+                for page in store.export_reports(keys_set, start, end, page_size=EXPORT_PAGE_SIZE, after=after,
+                                                 conn=conn):
+                    yield writer.rows([row[1:] for row in page])
+                yield writer.footer()
+            finally:
+                conn.close()
+
+    return StreamingResponse(body(), media_type=writer.media_type, headers=headers)
+
+
+@router.post("/Tag_Removal/", summary="Remove everything from Database with given hashed, advertisement, or private key.")
 async def tag_removal(
         keys: Annotated[str, Query(
             description="Key in Base64 format. Separate each key by a comma.")]):
@@ -834,16 +1141,47 @@ async def tag_removal(
             content={"error": f"No valid Base64 Key(s) found"},
             status_code=400)
 
-    for key in keys_set:
-        _sq3.execute("DELETE FROM tags WHERE hash_adv_key = ? OR private_key = ?", (key, key))
-        _sq3.execute("DELETE FROM reports WHERE id = ?", (key,))
-
-    sq3db.commit()
+    tag_keys = store.tag_private_keys()
+    decrypt_cache.forget(keys_set | {hash_key for hash_key, private_key in tag_keys.items() if private_key in keys_set})
+    key_map.forget(keys_set)
+    store.remove_keys(keys_set)
     return JSONResponse(
         content={"success": f"Key(s) removed from database"},
         status_code=200)
 
 
+@router.get("/metrics", summary="Prometheus metrics.", include_in_schema=False)
+async def metrics():
+    """
+    Per-stage latency histograms (anisette, upstream, parse, decrypt, sqlite, mqtt), upstream status codes,
+    report, cache and MQTT publish counters in the Prometheus text format.
+    """
+    if not PROMETHEUS_AVAILABLE:
+        return JSONResponse(
+            content={"error": f"Metrics need prometheus_client, install it with pip install prometheus_client"},
+            status_code=501)
+    content, media_type = render_metrics()
+    return Response(content=content, media_type=media_type)
+
+
+def main():
+    args = parser.parse_args()
+    # Log in before any worker starts, a prompt in a worker process would never be answered
+    load_auth(args.auth, add_account=args.add_account)
+    os.environ[ARGS_ENV] = shlex.join(sys.argv[1:])
+
+    metrics_dir = None
+    if args.workers > 1 and PROMETHEUS_AVAILABLE and not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Workers write their metrics here so /metrics adds up all of them, whichever worker is scraped
+        metrics_dir = tempfile.mkdtemp(prefix="findmy-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    try:
+        uvicorn.run("web_service:create_app", factory=True, host=args.host, port=args.port, workers=args.workers,
+                    log_level="info")
+    finally:
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
 if __name__ == "__main__":
-    getAuth()
-    uvicorn.run("web_service:app", host="127.0.0.1", port=8000, log_level="info")
+    main()